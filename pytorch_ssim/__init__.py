@@ -1,8 +1,13 @@
 import torch
 import torch.nn.functional as F
 from torch.autograd import Variable
+from torch.utils.checkpoint import checkpoint
 import numpy as np
 from math import exp
+from collections import OrderedDict
+
+WINDOW_CACHE_SIZE = 16
+_window_cache = OrderedDict()
 
 def gaussian(window_size, sigma):
     gauss = torch.Tensor([exp(-(x - window_size//2)**2/float(2*sigma**2)) for x in range(window_size)])
@@ -14,60 +19,107 @@ def create_window(window_size, channel):
     window = Variable(_2D_window.expand(channel, 1, window_size, window_size).contiguous())
     return window
 
-def _ssim(img1, img2, window, window_size, channel, size_average = True):
-    mu1 = F.conv2d(img1, window, padding = window_size//2, groups = channel)
-    mu2 = F.conv2d(img2, window, padding = window_size//2, groups = channel)
+def get_window(window_size, channel, device, dtype, sigma = 1.5):
+    # Separable window (5*channel, 1, window_size, 1) used by _ssim, cached by
+    # (window_size, sigma, channel, device, dtype) with LRU eviction
+    key = (window_size, sigma, channel, torch.device(device), dtype)
+    if key in _window_cache:
+        _window_cache.move_to_end(key)
+        return _window_cache[key]
+
+    window = gaussian(window_size, sigma).view(1, 1, window_size, 1).repeat(5*channel, 1, 1, 1)
+    window = window.to(device = device, dtype = dtype)
+
+    _window_cache[key] = window
+    if len(_window_cache) > WINDOW_CACHE_SIZE:
+        _window_cache.popitem(last = False)
+    return window
+
+def _ssim_map(img1, img2, window, window_size, channel, row_padding):
+    # mu1, mu2, img1^2, img2^2 and img1*img2 filtered at once by two grouped 1D convolutions,
+    # window is the 1D gaussian repeated for the 5 stacked inputs (see get_window)
+    stacked = torch.cat([img1, img2, img1*img1, img2*img2, img1*img2], dim = 1)
+    filtered = F.conv2d(stacked, window, padding = (row_padding, 0), groups = 5*channel)
+    filtered = F.conv2d(filtered, window.view(5*channel, 1, 1, window_size), padding = (0, window_size//2), groups = 5*channel)
+    mu1, mu2, img1_sq, img2_sq, img1_img2 = filtered.split(channel, dim = 1)
 
     mu1_sq = mu1.pow(2)
     mu2_sq = mu2.pow(2)
     mu1_mu2 = mu1*mu2
 
-    sigma1_sq = F.conv2d(img1*img1, window, padding = window_size//2, groups = channel) - mu1_sq
-    sigma2_sq = F.conv2d(img2*img2, window, padding = window_size//2, groups = channel) - mu2_sq
-    sigma12 = F.conv2d(img1*img2, window, padding = window_size//2, groups = channel) - mu1_mu2
+    sigma1_sq = img1_sq - mu1_sq
+    sigma2_sq = img2_sq - mu2_sq
+    sigma12 = img1_img2 - mu1_mu2
 
     C1 = 0.01**2
     C2 = 0.03**2
 
-    ssim_map = ((2*mu1_mu2 + C1)*(2*sigma12 + C2))/((mu1_sq + mu2_sq + C1)*(sigma1_sq + sigma2_sq + C2))
+    return ((2*mu1_mu2 + C1)*(2*sigma12 + C2))/((mu1_sq + mu2_sq + C1)*(sigma1_sq + sigma2_sq + C2))
+
+def _ssim(img1, img2, window, window_size, channel, size_average = True):
+    ssim_map = _ssim_map(img1, img2, window, window_size, channel, window_size//2)
 
     if size_average:
         return ssim_map.mean()
     else:
         return ssim_map.mean(1).mean(1).mean(1)
 
+def _ssim_band_sum(img1, img2, window, window_size, channel, row_start, row_end):
+    # Sum per sample of the ssim map rows [row_start, row_end), from the band rows plus a halo
+    # of window_size//2 rows, zero padded only where the halo goes past the image
+    halo = window_size//2
+    top = max(row_start - halo, 0)
+    bottom = min(row_end + halo, img1.size(2))
+    padding = (0, 0, halo - (row_start - top), halo - (bottom - row_end))
+
+    band1 = F.pad(img1[:, :, top:bottom], padding)
+    band2 = F.pad(img2[:, :, top:bottom], padding)
+    ssim_map = _ssim_map(band1, band2, window, window_size, channel, 0)
+
+    return ssim_map.sum(dim = 3).sum(dim = 2).sum(dim = 1)
+
+def _ssim_streaming(img1, img2, window, window_size, channel, size_average = True, band_size = 256):
+    # Same result as _ssim computed over bands of band_size rows, peak memory depends on the
+    # band size. Bands are recomputed in backward (checkpoint) when gradients are needed
+    (_, _, height, width) = img1.size()
+    needs_grad = torch.is_grad_enabled() and (img1.requires_grad or img2.requires_grad)
+
+    ssim_sum = 0
+    for row_start in range(0, height, band_size):
+        row_end = min(row_start + band_size, height)
+        if needs_grad:
+            ssim_sum = ssim_sum + checkpoint(_ssim_band_sum, img1, img2, window, window_size, channel, row_start, row_end, use_reentrant = True)
+        else:
+            ssim_sum = ssim_sum + _ssim_band_sum(img1, img2, window, window_size, channel, row_start, row_end)
+
+    ssim_per_sample = ssim_sum / (channel * height * width)
+
+    if size_average:
+        return ssim_per_sample.mean()
+    else:
+        return ssim_per_sample
+
 class SSIM(torch.nn.Module):
-    def __init__(self, window_size = 11, size_average = True):
+    def __init__(self, window_size = 11, size_average = True, band_size = None):
         super(SSIM, self).__init__()
         self.window_size = window_size
         self.size_average = size_average
-        self.channel = 1
-        self.window = create_window(window_size, self.channel)
+        self.band_size = band_size
 
     def forward(self, img1, img2):
         (_, channel, _, _) = img1.size()
+        window = get_window(self.window_size, channel, img1.device, img1.dtype)
 
-        if channel == self.channel and self.window.data.type() == img1.data.type():
-            window = self.window
-        else:
-            window = create_window(self.window_size, channel)
-            
-            if img1.is_cuda:
-                window = window.cuda(img1.get_device())
-            window = window.type_as(img1)
-            
-            self.window = window
-            self.channel = channel
-
+        if self.band_size is not None:
+            return _ssim_streaming(img1, img2, window, self.window_size, channel, self.size_average, self.band_size)
 
         return _ssim(img1, img2, window, self.window_size, channel, self.size_average)
 
-def ssim(img1, img2, window_size = 11, size_average = True):
+def ssim(img1, img2, window_size = 11, size_average = True, band_size = None):
     (_, channel, _, _) = img1.size()
-    window = create_window(window_size, channel)
-    
-    if img1.is_cuda:
-        window = window.cuda(img1.get_device())
-    window = window.type_as(img1)
-    
+    window = get_window(window_size, channel, img1.device, img1.dtype)
+
+    if band_size is not None:
+        return _ssim_streaming(img1, img2, window, window_size, channel, size_average, band_size)
+
     return _ssim(img1, img2, window, window_size, channel, size_average)
@@ -2,14 +2,36 @@
 
 __all__ = ["index", "modules", "custom_doc_links", "git_url"]
 
-index = {"PicturesDataset": "autoencoder.ipynb",
+index = {"DATA_DIRS": "autoencoder.ipynb",
+         "STAGES": "autoencoder.ipynb",
+         "StageTimings": "autoencoder.ipynb",
+         "PicturesDataset": "autoencoder.ipynb",
+         "pack_pictures": "autoencoder.ipynb",
+         "augment_batch": "autoencoder.ipynb",
          "plot_pictures": "autoencoder.ipynb",
+         "init_distributed": "autoencoder.ipynb",
          "create_dataloaders": "autoencoder.ipynb",
+         "FusedAutoencoder": "autoencoder.ipynb",
+         "export_autoencoder": "autoencoder.ipynb",
+         "QuantizedAutoencoder": "autoencoder.ipynb",
+         "quantize_autoencoder": "autoencoder.ipynb",
+         "quantization_report": "autoencoder.ipynb",
+         "plan_micro_batch": "autoencoder.ipynb",
+         "benchmark_compile": "autoencoder.ipynb",
+         "StepProfiler": "autoencoder.ipynb",
+         "PNGWriter": "autoencoder.ipynb",
+         "Checkpointer": "autoencoder.ipynb",
          "autoencoder": "autoencoder.ipynb",
+         "TrialPruner": "autoencoder.ipynb",
+         "trial_key": "autoencoder.ipynb",
          "fit_and_log": "autoencoder.ipynb",
+         "parallel_fmin": "autoencoder.ipynb",
+         "invalidate_cache": "autoencoder.ipynb",
          "parse_args": "autoencoder.ipynb",
          "main": "autoencoder.ipynb",
-         "create_test_loaders": "autoencoder.ipynb"}
+         "create_test_loaders": "autoencoder.ipynb",
+         "InferenceService": "autoencoder.ipynb",
+         "serve": "autoencoder.ipynb"}
 
 modules = ["autoencoder.py"]
 
@@ -1,7 +1,10 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nbs/autoencoder.ipynb (unless otherwise specified).
 
-__all__ = ['PicturesDataset', 'plot_pictures', 'create_dataloaders', 'autoencoder', 'fit_and_log', 'parse_args', 'main',
-           'create_test_loaders']
+__all__ = ['DATA_DIRS', 'STAGES', 'StageTimings', 'PicturesDataset', 'pack_pictures', 'augment_batch', 'plot_pictures',
+           'init_distributed', 'create_dataloaders', 'FusedAutoencoder', 'export_autoencoder', 'QuantizedAutoencoder',
+           'quantize_autoencoder', 'quantization_report', 'plan_micro_batch', 'benchmark_compile', 'StepProfiler',
+           'PNGWriter', 'Checkpointer', 'autoencoder', 'TrialPruner', 'trial_key', 'fit_and_log', 'parallel_fmin',
+           'invalidate_cache', 'parse_args', 'main', 'create_test_loaders', 'InferenceService', 'serve']
 
 # Cell
 import gc
@@ -12,24 +15,116 @@ gc.get_count()
 # imports
 
 import os
+import io
+import asyncio
+import copy
 import glob
+import json
 import time
+import shutil
+import hashlib
+import inspect
 import random
+import resource
+import tempfile
+import threading
+import contextlib
 from tqdm import tqdm
+from typing import List
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import matplotlib.pyplot as plt
 
 import torch
 import numpy as np
+import pandas as pd
 import pytorch_ssim
 import torch.nn as nn
+import torch.distributed as dist
+import torch.nn.functional as F
 from PIL import Image
 from torchinfo import summary
 from ignite.metrics import PSNR, SSIM
 from torchvision import transforms
-from torchvision.utils import save_image
 from torch.optim import AdamW, lr_scheduler
 import torchvision.transforms.functional as TF
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, Subset
+from torch.utils.data.dataloader import default_collate
+from torch.utils.data.distributed import DistributedSampler
+from torch.utils.checkpoint import checkpoint
+from torch.nn.parallel import DistributedDataParallel
+from torch.quantization import QConfig, QuantStub, DeQuantStub, default_weight_observer
+
+# Cell
+DATA_DIRS = {'train': './data/train',
+             'val': './data/val',
+             'test': './data/test'}
+
+def _list_pictures(mode):
+
+    data_dir = DATA_DIRS[mode]
+
+    if mode != 'test':
+        return {'lr': sorted(glob.glob(f'{data_dir}/lr/*.png')),
+                'hr': sorted(glob.glob(f'{data_dir}/hr/*.png'))}
+
+    file_names_lr = []
+    for folder in os.listdir(data_dir):
+        file_names_lr += glob.glob(f'{data_dir}/{folder}/*.png')
+
+    return {'lr': sorted(file_names_lr)}
+
+# Cell
+STAGES = ['read_lr', 'flip_lr', 'normalize_lr', 'rescale_lr', 'read_hr', 'flip_hr', 'normalize_hr',
+          'patches', 'da_rotate', 'da_flip', 'da_crop', 'da_resize', 'final_resize']
+
+class StageTimings(object):
+    """Latency histograms (log-spaced bins from min_time to max_time seconds) of named stages.
+    Counts are kept in shared memory with one row per DataLoader worker (row 0 for the main
+    process), so workers record without copies or locks and summary merges the rows."""
+
+    def __init__(self, stages, n_rows=None, n_bins=100, min_time=1e-6, max_time=100.):
+
+        self.stages = list(stages)
+        self.n_rows = n_rows or os.cpu_count() + 1
+        self.edges = np.geomspace(min_time, max_time, n_bins - 1)
+
+        self.counts = torch.zeros(self.n_rows, len(self.stages), n_bins, dtype=torch.int64).share_memory_()
+        self.sums = torch.zeros(self.n_rows, len(self.stages), dtype=torch.float64).share_memory_()
+
+    def record(self, stage, elapsed):
+
+        # Rows are not shared, the += below is not atomic across processes
+        worker_info = torch.utils.data.get_worker_info()
+        assert worker_info is None or worker_info.num_workers < self.n_rows, \
+            f'{worker_info.num_workers} workers for {self.n_rows} rows of stage timings'
+        row = 0 if worker_info is None else worker_info.id + 1
+
+        stage_idx = self.stages.index(stage)
+        self.counts[row, stage_idx, np.searchsorted(self.edges, elapsed, side='right')] += 1
+        self.sums[row, stage_idx] += elapsed
+
+    def summary(self):
+        """Count, mean and p50/p95/p99 (upper edge of the bin) in seconds of every recorded stage."""
+
+        counts = self.counts.sum(dim=0).numpy()
+        sums = self.sums.sum(dim=0).numpy()
+        upper_edges = np.append(self.edges, np.inf)
+
+        summary = {}
+        for stage_idx, stage in enumerate(self.stages):
+            n = counts[stage_idx].sum()
+            if n == 0: continue
+            cumulative = np.cumsum(counts[stage_idx]) / n
+            summary[stage] = {'count': int(n), 'mean': float(sums[stage_idx] / n)}
+            for q in [50, 95, 99]:
+                summary[stage][f'p{q}'] = float(upper_edges[np.searchsorted(cumulative, q / 100)])
+
+        return summary
+
+    def reset(self):
+        self.counts.zero_()
+        self.sums.zero_()
 
 # Cell
 class PicturesDataset(Dataset):
@@ -41,6 +136,12 @@ class PicturesDataset(Dataset):
                  data_augmentation=None,
                  interpolation=TF.InterpolationMode.NEAREST,
                  in_memory=False,
+                 packed_dir=None,
+                 patch_size=None,
+                 patches_per_image=1,
+                 native_lr=False,
+                 stage_timings=False,
+                 num_workers=None,
                  verbose=False):
 
         s = time.time()
@@ -51,13 +152,9 @@ class PicturesDataset(Dataset):
         if data_augmentation != None:
             for item in data_augmentation:
                 assert item in ['crop', 'rotate', 'flip']
+        assert patch_size == None or (mode == 'train' and patch_size % 4 == 0)
 
-        # Directory setup
-        data_dirs = {'train': './data/train',
-                     'val': './data/val',
-                     'test': './data/test'}
-
-        self.data_dir = data_dirs[mode]
+        self.data_dir = DATA_DIRS[mode]
         self.mode = mode
         self.final_size = final_size
         self.data_augmentation = data_augmentation
@@ -65,108 +162,197 @@ class PicturesDataset(Dataset):
         self.verbose = verbose
         self.interpolation = interpolation
         self.in_memory=in_memory
+        self.packed_dir = packed_dir
+        self.patch_size = patch_size
+        self.patches_per_image = patches_per_image
+        self.native_lr = native_lr
+
+        # Latency histograms of the preprocessing stages, shared by the num_workers DataLoader workers
+        self.stage_timings = None
+        if stage_timings:
+            self.stage_timings = StageTimings(STAGES, n_rows=None if num_workers is None else num_workers + 1)
+
+        # Test pictures keep their own size when final_size is None (tiled inference)
+        assert final_size != None or (mode == 'test' or patch_size != None)
+        assert final_size == None or not native_lr or final_size % 4 == 0
+        if final_size != None:
+            self.final_size_transf = transforms.Resize(size=[self.final_size, self.final_size],
+                                                       interpolation=self.interpolation)
+
+            # Native LR pictures are kept at 1/4 of the HR size, the model upsamples them
+            lr_final_size = self.final_size // 4 if native_lr else self.final_size
+            self.final_size_transf_lr = transforms.Resize(size=[lr_final_size, lr_final_size],
+                                                          interpolation=self.interpolation)
+
+        if packed_dir is not None:
+            # Pictures are read as uint8 views of the shards written by pack_pictures
+            with open(f'{packed_dir}/{mode}_index.json', 'r') as f:
+                self.packed_index = json.load(f)
+            self.shards = None
+            self.file_names_lr = self.packed_index['lr']['files']
+            if mode != 'test':
+                self.file_names_hr = self.packed_index['hr']['files']
+
+        else:
+            file_names = _list_pictures(mode)
+            self.file_names_lr = file_names['lr']
+            if mode != 'test':
+                self.file_names_hr = file_names['hr']
+
+        # Pictures are kept as uint8 in one shared memory buffer per kind, with their
+        # offsets and shapes in numpy arrays, so DataLoader workers attach to the same
+        # memory instead of holding a copy each
+        if in_memory:
+            self.memory_buffers = {}
+            self.memory_index = {}
+            for kind in (['lr'] if mode == 'test' else ['lr', 'hr']):
+                self.memory_buffers[kind], self.memory_index[kind] = self.load_shared_memory(kind)
 
-        self.final_size_transf = transforms.Resize(size=[self.final_size, self.final_size],
-                                                   interpolation=self.interpolation)
+        if verbose: print(f'class PicturesDataset Init time: {time.time() - s:0.2f}')
 
-        self.pic_to_tensor = transforms.ToTensor()
+    def __getstate__(self):
+        # Memory maps are opened again by each DataLoader worker instead of being pickled
+        state = self.__dict__.copy()
+        if 'shards' in state: state['shards'] = None
+        return state
 
-        if mode != 'test':
-            self.file_names_lr = sorted(glob.glob(f'{self.data_dir}/lr/*.png'))
-            self.file_names_hr = sorted(glob.glob(f'{self.data_dir}/hr/*.png'))
+    def load_shared_memory(self, kind):
 
-            if in_memory:
-                self.pics_lr = [self.pic_to_tensor(Image.open(f)) for f in self.file_names_lr]
-                self.pics_hr = [self.pic_to_tensor(Image.open(f)) for f in self.file_names_hr]
+        file_names = self.file_names_lr if kind == 'lr' else self.file_names_hr
 
+        # Shapes (C, H, W) from the packed index or the png headers, without decoding
+        if self.packed_dir is not None:
+            shapes = np.array(self.packed_index[kind]['shapes'], dtype=np.int64)
         else:
-            self.file_names_lr = []
-            for folder in os.listdir(self.data_dir):
-                self.file_names_lr += glob.glob(f'{self.data_dir}/{folder}/*.png')
-            self.file_names_lr = sorted(self.file_names_lr)
+            shapes = []
+            for f in file_names:
+                with Image.open(f) as pic:
+                    shapes.append([len(pic.getbands()), pic.size[1], pic.size[0]])
+            shapes = np.array(shapes, dtype=np.int64)
 
-            if in_memory:
-                self.pics_lr = [self.pic_to_tensor(Image.open(f)) for f in self.file_names_lr]
+        sizes = shapes.prod(axis=1)
+        offsets = np.concatenate([[0], np.cumsum(sizes)[:-1]]).astype(np.int64)
 
-        if verbose: print(f'class PicturesDataset Init time: {time.time() - s:0.2f}')
+        buffer = torch.empty(int(sizes.sum()), dtype=torch.uint8).share_memory_()
+        for idx in range(len(file_names)):
+            buffer[offsets[idx]:offsets[idx] + sizes[idx]] = self.read_uint8(kind, idx).flatten()
+
+        return buffer, {'offsets': offsets, 'shapes': shapes}
+
+    def read_uint8(self, kind, idx):
+
+        if self.packed_dir is not None:
+            if self.shards is None:
+                self.shards = {k: [np.memmap(f'{self.packed_dir}/{shard}', dtype=np.uint8, mode='c')
+                                   for shard in entries['shards']]
+                               for k, entries in self.packed_index.items()}
+
+            entries = self.packed_index[kind]
+            shape = entries['shapes'][idx]
+            offset = entries['offsets'][idx]
+            shard = self.shards[kind][entries['shard_ids'][idx]]
+            return torch.from_numpy(shard[offset:offset + int(np.prod(shape))].reshape(shape))
+
+        file_names = self.file_names_lr if kind == 'lr' else self.file_names_hr
+        return TF.pil_to_tensor(Image.open(file_names[idx]))
 
+    def read_picture(self, kind, idx):
+
+        if self.in_memory:
+            offset = int(self.memory_index[kind]['offsets'][idx])
+            shape = self.memory_index[kind]['shapes'][idx].tolist()
+            pic = self.memory_buffers[kind][offset:offset + int(np.prod(shape))].view(*shape)
+        else:
+            pic = self.read_uint8(kind, idx)
+
+        return pic.float().div(255)
 
     def __len__(self):
         return len(self.file_names_lr)
 
+    def record_time(self, stage, start):
+        if self.stage_timings is not None:
+            self.stage_timings.record(stage, time.perf_counter() - start)
+
     def __getitem__(self, idx):
 
         # Low resolution image (x)
-        s = time.time()
-        if self.in_memory: pic_lr = self.pics_lr[idx]
-        else: pic_lr = transforms.ToTensor()(Image.open(self.file_names_lr[idx]))
+        s = time.perf_counter()
+        pic_lr = self.read_picture('lr', idx)
         if pic_lr.shape[0] < 3: pic_lr = pic_lr.expand(3, pic_lr.shape[1], pic_lr.shape[2])
-        if self.verbose: print(f'LR image reading time: {time.time() - s:0.2f}')
+        self.record_time('read_lr', s)
 
         # Flip dimensions to have height as longest dimension
-        s = time.time()
-        if pic_lr.shape[2] > pic_lr.shape[1]:
+        s = time.perf_counter()
+        flipped = pic_lr.shape[2] > pic_lr.shape[1]
+        if flipped:
             pic_lr = pic_lr.transpose(1, 2)
-        if self.verbose: print(f'LR Flipping time: {time.time() - s:0.2f}')
+        self.record_time('flip_lr', s)
 
         # Normalization
-        s = time.time()
+        s = time.perf_counter()
         if self.normalize:
             pic_lr_mean = torch.mean(pic_lr.flatten(start_dim=1), dim=1)
             pic_lr_std = torch.std(pic_lr.flatten(start_dim=1), dim=1)
             pic_lr = TF.normalize(pic_lr, mean=pic_lr_mean, std=pic_lr_std)
-        if self.verbose: print(f'LR Normalization time: {time.time() - s:0.2f}')
+        self.record_time('normalize_lr', s)
 
-        # 4x rescaling
-        s = time.time()
+        # 4x rescaling (patches are rescaled after being cropped)
+        s = time.perf_counter()
         pic_lr_h, pic_lr_w = pic_lr.shape[1], pic_lr.shape[2]
-        pic_lr = TF.resize(pic_lr,
-                           size=[4*pic_lr_h, 4*pic_lr_w],
-                           interpolation=self.interpolation)
-        if self.verbose: print(f'LR Rescaling time: {time.time() - s:0.2f}')
+        if self.patch_size == None and not self.native_lr:
+            pic_lr = TF.resize(pic_lr,
+                               size=[4*pic_lr_h, 4*pic_lr_w],
+                               interpolation=self.interpolation)
+        self.record_time('rescale_lr', s)
 
         if self.mode != 'test':
 
             # High resolution image (target, just for training and validation)
-            s = time.time()
-            if self.in_memory: pic_hr = self.pics_hr[idx]
-            else: pic_hr = transforms.ToTensor()(Image.open(self.file_names_hr[idx]))
-            if self.verbose: print(f'HR image reading time: {time.time() - s:0.2f}')
+            s = time.perf_counter()
+            pic_hr = self.read_picture('hr', idx)
+            self.record_time('read_hr', s)
 
             # Flip dimensions to have height as longest dimension
-            s = time.time()
+            s = time.perf_counter()
             if pic_hr.shape[2] > pic_hr.shape[1]:
                 pic_hr = pic_hr.transpose(1, 2)
-            if self.verbose: print(f'HR Flipping time: {time.time() - s:0.2f}')
+            self.record_time('flip_hr', s)
 
             # Normalization
-            s = time.time()
+            s = time.perf_counter()
             if self.normalize:
                 pic_hr_mean = torch.mean(pic_hr.flatten(start_dim=1), dim=1)
                 pic_hr_std = torch.std(pic_hr.flatten(start_dim=1), dim=1)
                 pic_hr = TF.normalize(pic_hr, mean=pic_hr_mean, std=pic_hr_std)
-            if self.verbose: print(f'HR Normalization time: {time.time() - s:0.2f}')
+            self.record_time('normalize_hr', s)
+
+            # Aligned patches instead of full frames
+            if self.patch_size != None:
+                return self.sample_patches(pic_lr, pic_hr)
 
             # Data augmentation for x and target
             if self.data_augmentation != None:
                 pic_lr, pic_hr = self.data_augmentation_transform(pic_lr, pic_hr)
 
             # Final resize
-            s = time.time()
+            s = time.perf_counter()
 
-            pic_lr = self.final_size_transf(pic_lr)
+            pic_lr = self.final_size_transf_lr(pic_lr)
             pic_hr = self.final_size_transf(pic_hr)
-            if self.verbose: print(f'Final resize time: {time.time() - s:0.2f}')
+            self.record_time('final_resize', s)
 
             return pic_lr, pic_hr
 
         else:
             # Final resize
-            s = time.time()
-            pic_lr = self.final_size_transf(pic_lr)
-            if self.verbose: print(f'Final resize time: {time.time() - s:0.2f}')
+            s = time.perf_counter()
+            if self.final_size != None:
+                pic_lr = self.final_size_transf_lr(pic_lr)
+            self.record_time('final_resize', s)
 
-            pic_lr_size = {'heights': pic_lr_h, 'widths': pic_lr_w}
+            # Sizes after the flip, predictions are flipped back to the orientation of the picture
+            pic_lr_size = {'heights': pic_lr_h, 'widths': pic_lr_w, 'flipped': flipped}
             if not self.normalize:
                 pic_lr_mean = -1
                 pic_lr_std = -1
@@ -175,23 +361,59 @@ class PicturesDataset(Dataset):
             return pic_lr, pic_lr_size, pic_lr_norm_params
 
 
+    def sample_patches(self, pic_lr, pic_hr):
+
+        # Random LR patches and their HR counterparts at the same position, only the
+        # patches are rescaled and augmented. Returns (patches_per_image, 3, patch_size, patch_size),
+        # or patch_size // 4 for native LR patches
+        s = time.perf_counter()
+        lr_patch_size = self.patch_size // 4
+        pic_lr_h, pic_lr_w = pic_lr.shape[1], pic_lr.shape[2]
+
+        patches_lr = []
+        patches_hr = []
+        for _ in range(self.patches_per_image):
+            i = np.random.randint(0, pic_lr_h - lr_patch_size + 1)
+            j = np.random.randint(0, pic_lr_w - lr_patch_size + 1)
+
+            patch_lr = pic_lr[:, i:i + lr_patch_size, j:j + lr_patch_size]
+            patch_hr = pic_hr[:, 4*i:4*i + self.patch_size, 4*j:4*j + self.patch_size]
+
+            if not self.native_lr:
+                patch_lr = TF.resize(patch_lr,
+                                     size=[self.patch_size, self.patch_size],
+                                     interpolation=self.interpolation)
+
+            if self.data_augmentation != None:
+                patch_lr, patch_hr = self.data_augmentation_transform(patch_lr, patch_hr)
+
+            patches_lr.append(patch_lr)
+            patches_hr.append(patch_hr)
+        self.record_time('patches', s)
+
+        return torch.stack(patches_lr), torch.stack(patches_hr)
+
     def data_augmentation_transform(self, pic_lr, pic_hr):
 
-        assert pic_lr.shape == pic_hr.shape
+        # LR pictures are either upscaled to the HR shape or native (4 times smaller)
+        scale = int(round(pic_hr.shape[1] / pic_lr.shape[1]))
+        assert scale in [1, 4]
+        assert scale > 1 or pic_lr.shape == pic_hr.shape
 
         pic_h, pic_w = pic_lr.shape[1], pic_lr.shape[2]
+        pic_hr_h, pic_hr_w = pic_hr.shape[1], pic_hr.shape[2]
 
         # Random rotation
-        s = time.time()
+        s = time.perf_counter()
         if 'rotate' in self.data_augmentation:
             angle = transforms.RandomRotation.get_params(degrees=[-45,45])
 
             pic_lr = TF.rotate(pic_lr, angle=angle)
             pic_hr = TF.rotate(pic_hr, angle=angle)
-        if self.verbose: print(f'DA Rotation time: {time.time() - s:0.2f}')
+        self.record_time('da_rotate', s)
 
         # Random flip
-        s = time.time()
+        s = time.perf_counter()
         if 'flip' in self.data_augmentation:
 
             # Random horizontal flipping
@@ -203,10 +425,10 @@ class PicturesDataset(Dataset):
             if np.random.random() > 0.5:
                 pic_lr = TF.vflip(pic_lr)
                 pic_hr = TF.vflip(pic_hr)
-        if self.verbose: print(f'DA Random Flipping time: {time.time() - s:0.2f}')
+        self.record_time('da_flip', s)
 
         # Random crop
-        s = time.time()
+        s = time.perf_counter()
         if 'crop' in self.data_augmentation:
             crop_factor = np.random.uniform(low=0.5, high=0.75)
             crop_h = np.round(crop_factor * pic_h, decimals=0).astype(int)
@@ -216,19 +438,118 @@ class PicturesDataset(Dataset):
                                                           output_size=(crop_h, crop_w))
 
             pic_lr = TF.crop(img=pic_lr, top=i, left=j, height=h, width=w)
-            pic_hr = TF.crop(img=pic_hr, top=i, left=j, height=h, width=w)
-        if self.verbose: print(f'DA Cropping time: {time.time() - s:0.2f}')
+            pic_hr = TF.crop(img=pic_hr, top=scale*i, left=scale*j, height=scale*h, width=scale*w)
+        self.record_time('da_crop', s)
 
         # Resize to original shape
-        s = time.time()
-        original_size = transforms.Resize(size=[pic_h, pic_w],
-                                          interpolation=self.interpolation)
-        pic_lr = original_size(pic_lr)
-        pic_hr = original_size(pic_hr)
-        if self.verbose: print(f'DA Resizing time: {time.time() - s:0.2f}')
+        s = time.perf_counter()
+        pic_lr = TF.resize(pic_lr, size=[pic_h, pic_w], interpolation=self.interpolation)
+        pic_hr = TF.resize(pic_hr, size=[pic_hr_h, pic_hr_w], interpolation=self.interpolation)
+        self.record_time('da_resize', s)
 
         return pic_lr, pic_hr
 
+# Cell
+def pack_pictures(mode, packed_dir='./data/packed', shard_size=2**30):
+    """Writes the pictures of a set into uint8 shards (C, H, W) plus a json index
+    with the shard, offset and shape of each picture, to be read by PicturesDataset."""
+
+    assert mode in ['train', 'val', 'test']
+
+    if not os.path.exists(packed_dir):
+        os.makedirs(packed_dir)
+
+    index = {}
+
+    for kind, file_names in _list_pictures(mode).items():
+
+        entries = {'files': file_names, 'shards': [], 'shard_ids': [], 'offsets': [], 'shapes': []}
+        shard, offset = None, 0
+
+        for f in tqdm(file_names):
+            with Image.open(f) as pic:
+                pic = np.asarray(pic)
+            assert pic.dtype == np.uint8
+            if pic.ndim == 2: pic = pic[:, :, None]
+            pic = np.ascontiguousarray(pic.transpose(2, 0, 1))
+
+            # New shard when the current one is full
+            if shard is None or (offset > 0 and offset + pic.nbytes > shard_size):
+                if shard is not None: shard.close()
+                entries['shards'].append(f'{mode}_{kind}_{len(entries["shards"]):03d}.u8')
+                shard = open(f'{packed_dir}/{entries["shards"][-1]}', 'wb')
+                offset = 0
+
+            shard.write(pic.tobytes())
+            entries['shard_ids'].append(len(entries['shards']) - 1)
+            entries['offsets'].append(offset)
+            entries['shapes'].append(list(pic.shape))
+            offset += pic.nbytes
+
+        if shard is not None: shard.close()
+        index[kind] = entries
+
+    with open(f'{packed_dir}/{mode}_index.json', 'w') as f:
+        json.dump(index, f)
+
+# Cell
+def _augmentation_params(batch_size, data_augmentation, generator=None):
+    # Rotation angle (radians, counter-clockwise as TF.rotate), flips (-1 for flipped x and y) and
+    # crop scale and center (normalized coordinates) of each sample
+    angle = torch.zeros(batch_size)
+    flip = torch.ones(batch_size, 2)
+    scale = torch.ones(batch_size)
+    shift = torch.zeros(batch_size, 2)
+
+    if 'rotate' in data_augmentation:
+        angle = (torch.rand(batch_size, generator=generator) * 90 - 45) * np.pi / 180
+
+    if 'flip' in data_augmentation:
+        flip = 1 - 2 * (torch.rand(batch_size, 2, generator=generator) > 0.5).float()
+
+    if 'crop' in data_augmentation:
+        scale = 0.5 + 0.25 * torch.rand(batch_size, generator=generator)
+        shift = (1 - scale).unsqueeze(1) * (2 * torch.rand(batch_size, 2, generator=generator) - 1)
+
+    return angle, flip, scale, shift
+
+def _augmentation_theta(angle, flip, scale, shift, height, width):
+    # Output to input normalized coordinates: rotation @ flip @ (scale * x + shift). The rotation
+    # is done in pixels, normalized coordinates of non square pictures have different units in x and y
+    cos, sin = torch.cos(angle), torch.sin(angle)
+    rotation = torch.stack([torch.stack([cos, -sin * height / width], dim=1),
+                            torch.stack([sin * width / height, cos], dim=1)], dim=1)
+    linear = rotation * flip.unsqueeze(1)
+    return torch.cat([linear * scale.view(-1, 1, 1), linear @ shift.unsqueeze(2)], dim=2)
+
+def _warp_batch(pics_lr, pics_hr, theta, interpolation):
+    # LR and HR are warped together, native LR pictures with their own grid
+    theta = theta.to(device=pics_hr.device, dtype=pics_hr.dtype)
+    if pics_lr.shape[2:] == pics_hr.shape[2:]:
+        pics = torch.cat([pics_lr, pics_hr], dim=1)
+        grid = F.affine_grid(theta, size=list(pics.shape), align_corners=False)
+        pics = F.grid_sample(pics, grid, mode=interpolation.value, padding_mode='zeros', align_corners=False)
+        return pics[:, :pics_lr.shape[1]], pics[:, pics_lr.shape[1]:]
+
+    pics = []
+    for pic in [pics_lr, pics_hr]:
+        grid = F.affine_grid(theta, size=list(pic.shape), align_corners=False)
+        pics.append(F.grid_sample(pic, grid, mode=interpolation.value, padding_mode='zeros', align_corners=False))
+
+    return pics[0], pics[1]
+
+def augment_batch(pics_lr, pics_hr, data_augmentation, interpolation, generator=None):
+    """Random rotation, flips and crop (resized back to the input size) of every LR/HR pair
+    of a batch, composed into one affine matrix per sample and applied with a single
+    grid_sample on the device of the batch. Parameters are drawn on CPU from generator."""
+
+    assert pics_lr.shape[0] == pics_hr.shape[0]
+
+    angle, flip, scale, shift = _augmentation_params(pics_lr.shape[0], data_augmentation, generator)
+    theta = _augmentation_theta(angle, flip, scale, shift, pics_hr.shape[2], pics_hr.shape[3])
+
+    return _warp_batch(pics_lr, pics_hr, theta, interpolation)
+
 # Cell
 def plot_pictures(dataset, idx='random'):
 
@@ -312,16 +633,79 @@ def plot_pictures(dataset, idx='random'):
         plt.show()
 
 # Cell
+def init_distributed():
+    """Joins the process group of a torchrun launch (WORLD_SIZE > 1), with NCCL on GPUs and gloo on CPU.
+    Returns the rank and world size, (0, 1) for single process runs."""
+
+    if int(os.environ.get('WORLD_SIZE', 1)) > 1 and not dist.is_initialized():
+        dist.init_process_group(backend='nccl' if torch.cuda.is_available() else 'gloo')
+        if torch.cuda.is_available():
+            torch.cuda.set_device(int(os.environ.get('LOCAL_RANK', 0)))
+
+    return _rank(), _world_size()
+
+def _rank():
+    return dist.get_rank() if dist.is_initialized() else 0
+
+def _world_size():
+    return dist.get_world_size() if dist.is_initialized() else 1
+
+def _all_reduce_mean(value, device):
+    # Mean of a python number over the processes
+    if not dist.is_initialized(): return value
+    value = torch.tensor(float(value), device=device)
+    dist.all_reduce(value)
+    return value.item() / dist.get_world_size()
+
+def _all_reduce_min(value, device):
+    # Minimum of a python integer over the processes
+    if not dist.is_initialized(): return value
+    value = torch.tensor(int(value), device=device)
+    dist.all_reduce(value, op=dist.ReduceOp.MIN)
+    return int(value.item())
+
+def _broadcast_object(value):
+    # Value of rank 0 on every process
+    if not dist.is_initialized(): return value
+    values = [value]
+    dist.broadcast_object_list(values, src=0)
+    return values[0]
+
+def _all_gather_object(value):
+    # Values of every process, in rank order
+    if not dist.is_initialized(): return [value]
+    values = [None] * dist.get_world_size()
+    dist.all_gather_object(values, value)
+    return values
+
+# Cell
+def _collate_patches(batch):
+    # Patches of every picture of the batch are concatenated in a single batch
+    pics_lr, pics_hr = zip(*batch)
+    return torch.cat(pics_lr), torch.cat(pics_hr)
+
+def _collate_test_pictures(batch):
+    # Test pictures of different sizes (tiled inference) are kept in a list
+    pics_lr, sizes, norm_params = zip(*batch)
+    return list(pics_lr), default_collate(list(sizes)), default_collate(list(norm_params))
+
 def create_dataloaders(mc):
 
-    NUM_WORKERS = os.cpu_count()
+    NUM_WORKERS = mc.get('num_workers', os.cpu_count() // _world_size())
 
     train_dataset = PicturesDataset(mode='train',
                                     final_size=mc['final_size'],
                                     normalize=mc['normalize'],
-                                    data_augmentation=mc['data_augmentation'],
+                                    data_augmentation=None if mc.get('batch_augmentation', False) \
+                                                      else mc['data_augmentation'],
                                     interpolation=mc['interpolation'],
                                     in_memory=mc['in_memory'],
+                                    packed_dir=mc.get('packed_dir', None),
+                                    patch_size=mc.get('patch_size', None),
+                                    patches_per_image=mc.get('patches_per_image', 1),
+                                    native_lr=mc.get('native_lr', False),
+                                    stage_timings=mc.get('stage_timings', False),
+                                    num_workers=NUM_WORKERS,
                                     verbose=False)
 
 
@@ -332,14 +716,22 @@ def create_dataloaders(mc):
                                     data_augmentation=None,
                                     interpolation=mc['interpolation'],
                                     in_memory=mc['in_memory'],
+                                    packed_dir=mc.get('packed_dir', None),
+                                    native_lr=mc.get('native_lr', False),
+                                    stage_timings=mc.get('stage_timings', False),
+                                    num_workers=NUM_WORKERS,
                                     verbose=False)
 
     test_dataset =  PicturesDataset(mode='test',
-                                    final_size=mc['final_size'],
+                                    final_size=None if mc.get('tile_size', None) else mc['final_size'],
                                     normalize=mc['normalize'],
                                     data_augmentation=None,
                                     interpolation=mc['interpolation'],
                                     in_memory=False,
+                                    packed_dir=mc.get('packed_dir', None),
+                                    native_lr=mc.get('native_lr', False),
+                                    stage_timings=mc.get('stage_timings', False),
+                                    num_workers=NUM_WORKERS,
                                     verbose=False)
 
     display_str  = f'n_train: {len(train_dataset)} '
@@ -347,15 +739,24 @@ def create_dataloaders(mc):
     display_str += f'n_test: {len(test_dataset)} '
     print(display_str)
 
+    # Each process gets its own shard of the train and val sets, batch_size is per process
+    train_sampler, val_sampler = None, None
+    if _world_size() > 1:
+        train_sampler = DistributedSampler(train_dataset, shuffle=True, seed=mc['random_seed'])
+        val_sampler = DistributedSampler(val_dataset, shuffle=False)
+
     train_loader = DataLoader(train_dataset,
-                              shuffle=True,
+                              shuffle=train_sampler is None,
+                              sampler=train_sampler,
                               batch_size=mc['batch_size'],
                               num_workers=NUM_WORKERS,
                               pin_memory=torch.cuda.is_available(),
-                              drop_last=True)
+                              drop_last=True,
+                              collate_fn=_collate_patches if mc.get('patch_size', None) else None)
 
     val_loader = DataLoader(val_dataset,
                             shuffle=False,
+                            sampler=val_sampler,
                             batch_size=mc['batch_size'],
                             num_workers=NUM_WORKERS,
                             pin_memory=torch.cuda.is_available(),
@@ -366,15 +767,51 @@ def create_dataloaders(mc):
                              batch_size=mc['batch_size'],
                              num_workers=NUM_WORKERS,
                              pin_memory=torch.cuda.is_available(),
-                             drop_last=False)
+                             drop_last=False,
+                             collate_fn=_collate_test_pictures if mc.get('tile_size', None) else None)
 
     return train_loader, val_loader, test_loader
 
 # Cell
+class _DownBlock(nn.Module):
+    # Conv -> BN -> ReLU -> MaxPool, the conv output is the skip connection
+    def __init__(self, in_channels, out_channels):
+        super(_DownBlock, self).__init__()
+        self.conv = nn.Conv2d(in_channels=in_channels,
+                              out_channels=out_channels,
+                              kernel_size=3,
+                              padding=1)
+        self.bn = nn.BatchNorm2d(num_features=out_channels)
+        self.relu = nn.ReLU()
+        self.pool = nn.MaxPool2d(kernel_size=2,
+                                 stride=2)
+
+    def forward(self, x):
+        skip = self.conv(x)
+        return self.pool(self.relu(self.bn(skip))), skip
+
+class _UpBlock(nn.Module):
+    # ConvTranspose (preserving the output size from the encoder) -> + skip -> BN -> ReLU
+    def __init__(self, in_channels, out_channels):
+        super(_UpBlock, self).__init__()
+        self.conv_t = nn.ConvTranspose2d(in_channels=in_channels,
+                                         out_channels=out_channels,
+                                         kernel_size=2,
+                                         stride=2)
+        self.bn = nn.BatchNorm2d(num_features=out_channels)
+        self.relu = nn.ReLU()
+
+    def forward(self, x, skip):
+        x = self.conv_t(x, output_size=skip.shape)
+        x = x + skip
+        return self.relu(self.bn(x))
+
 class _autoencoder(nn.Module):
 
     def __init__(self,
-                 h_channels):
+                 h_channels,
+                 upscale_factor=1,
+                 checkpoint_blocks=None):
 
         super(_autoencoder, self).__init__()
 
@@ -386,74 +823,752 @@ class _autoencoder(nn.Module):
 
         # Input layer: (B, C=3, H, W)
 
-        # Encoder
-        encoder_layers = []
+        # Encoder (Convolutional Blocks - Downsampling)
+        self.encoder_blocks = nn.ModuleList([_DownBlock(self.channels_enc[i], self.channels_enc[i+1])
+                                             for i in range(len(h_channels))])
+
+        # Upsampling (Sub-pixel Convolutional Blocks), for native LR inputs
+        self.upsampling_blocks = nn.ModuleList([nn.Sequential(nn.Conv2d(in_channels=self.channels_dec[-1],
+                                                                        out_channels=4*self.channels_dec[-1],
+                                                                        kernel_size=3,
+                                                                        padding=1),
+                                                              nn.PixelShuffle(upscale_factor=2),
+                                                              nn.ReLU())
+                                                for _ in range(int(np.log2(upscale_factor)))])
+
+        # Decoder (Transpose Convolutional Blocks - Upsampling), registered after the upsampling blocks
+        # to keep the parameter order (and optimizer states) of the flat layout
+        self.decoder_blocks = nn.ModuleList([_UpBlock(self.channels_dec[i], self.channels_dec[i+1])
+                                             for i in range(len(self.channels_dec) - 1)])
+
+        self.output_block = nn.Sequential(nn.Conv2d(in_channels=self.channels_dec[-1],
+                                                    out_channels=self.channels_enc[0],
+                                                    kernel_size=3,
+                                                    padding=1),
+                                          nn.BatchNorm2d(num_features=self.channels_enc[0]),
+                                          nn.ReLU())
+
+        # Blocks ('encoder_{i}', 'decoder_{i}', or all the blocks of 'encoder' / 'decoder') whose
+        # activations are recomputed in the backward pass instead of kept, fixed per block so that
+        # the forward has no dynamic dispatch
+        checkpoint_blocks = set(checkpoint_blocks or [])
+        self.checkpoint_encoder = [f'encoder_{i}' in checkpoint_blocks or 'encoder' in checkpoint_blocks
+                                   for i in range(len(self.encoder_blocks))]
+        self.checkpoint_decoder = [f'decoder_{i}' in checkpoint_blocks or 'decoder' in checkpoint_blocks
+                                   for i in range(len(self.decoder_blocks))]
+
+        # Checkpoints of the flat ModuleList layout are converted when loaded
+        self._register_load_state_dict_pre_hook(self._convert_flat_layout)
+
+    def _convert_flat_layout(self, state_dict, prefix, *args):
+        # encoder_layers: [Conv, BN, ReLU, MaxPool] * n, decoder_layers: [ConvTranspose, BN, ReLU] * n
+        # + [Conv, BN, ReLU], upsampling_layers: [Conv, PixelShuffle, ReLU] * m
+        for key in list(state_dict.keys()):
+            if not key.startswith(prefix): continue
+            parts = key[len(prefix):].split('.', 2)
+            if len(parts) < 3: continue
+            name, idx, param = parts
+
+            if name == 'encoder_layers':
+                block, layer = divmod(int(idx), 4)
+                new_key = f'encoder_blocks.{block}.{["conv", "bn"][layer]}.{param}'
+            elif name == 'decoder_layers':
+                block, layer = divmod(int(idx), 3)
+                if block < len(self.decoder_blocks):
+                    new_key = f'decoder_blocks.{block}.{["conv_t", "bn"][layer]}.{param}'
+                else:
+                    new_key = f'output_block.{layer}.{param}'
+            elif name == 'upsampling_layers':
+                block, layer = divmod(int(idx), 3)
+                new_key = f'upsampling_blocks.{block}.{layer}.{param}'
+            else:
+                continue
+
+            state_dict[prefix + new_key] = state_dict.pop(key)
+
+    def checkpointed(self, block, x, *inputs):
+
+        def recompute_block(x, *inputs):
+            # checkpoint runs the block without grad first, then with grad during the backward pass,
+            # when the BatchNorm running statistics and batch counts must not be updated again
+            if not torch.is_grad_enabled():
+                return block(x, *inputs)
+            batch_norms = [layer for layer in block.modules() if isinstance(layer, nn.BatchNorm2d)]
+            momentums = [layer.momentum for layer in batch_norms]
+            batches_tracked = [layer.num_batches_tracked.clone() for layer in batch_norms]
+            for layer in batch_norms: layer.momentum = 0.
+            try:
+                return block(x, *inputs)
+            finally:
+                for layer, momentum, tracked in zip(batch_norms, momentums, batches_tracked):
+                    layer.momentum = momentum
+                    layer.num_batches_tracked.copy_(tracked)
+
+        # The inputs (and the skip tensors returned by the encoder blocks) are kept, the gradients
+        # of the block parameters need an input that requires grad
+        if not x.requires_grad:
+            x = x.detach().requires_grad_()
+        return checkpoint(recompute_block, x, *inputs, use_reentrant=True)
 
-        for i in range(len(h_channels)):
-            layer = [nn.Conv2d(in_channels=self.channels_enc[i],
-                               out_channels=self.channels_enc[i+1],
-                               kernel_size=3,
-                               padding=1),
-                     nn.BatchNorm2d(num_features=self.channels_enc[i+1]),
-                     nn.ReLU(),
-                     nn.MaxPool2d(kernel_size=2,
-                                  stride=2)]
-            encoder_layers += layer
+    def forward(self, x):
 
-        self.encoder_layers = nn.ModuleList(encoder_layers)
+        recompute = self.training and torch.is_grad_enabled()
 
-        # Decoder
-        decoder_layers = []
+        # Encoding
+        res_x = []
+        for i, block in enumerate(self.encoder_blocks):
+            if recompute and self.checkpoint_encoder[i]:
+                x, skip = self.checkpointed(block, x)
+            else:
+                x, skip = block(x)
+            res_x.append(skip) # skip connections
+
+        # Decoding
+        for i, block in enumerate(self.decoder_blocks):
+            skip = res_x[len(res_x) - 1 - i]
+            if recompute and self.checkpoint_decoder[i]:
+                x = self.checkpointed(block, x, skip)
+            else:
+                x = block(x, skip)
 
-        for i in range(len(self.channels_dec) - 1):
-            layer = [nn.ConvTranspose2d(in_channels=self.channels_dec[i],
-                                        out_channels=self.channels_dec[i+1],
-                                        kernel_size=2,
-                                        stride=2),
-                     nn.BatchNorm2d(num_features=self.channels_dec[i+1]),
-                     nn.ReLU()]
-            decoder_layers += layer
+        # Sub-pixel upsampling before the output block
+        for block in self.upsampling_blocks:
+            x = block(x)
 
-        decoder_layers += [nn.Conv2d(in_channels=self.channels_dec[i+1],
-                                    out_channels=self.channels_enc[0],
-                                    kernel_size=3,
-                                    padding=1),
-                           nn.BatchNorm2d(num_features=self.channels_enc[0]),
-                           nn.ReLU()]
+        return self.output_block(x)
 
-        self.decoder_layers = nn.ModuleList(decoder_layers)
+# Cell
+def _bn_affine(bn):
+    # Eval mode BatchNorm2d as a per-channel scale and shift
+    scale = bn.weight.detach() / torch.sqrt(bn.running_var + bn.eps)
+    shift = bn.bias.detach() - bn.running_mean * scale
+    return scale, shift
+
+class _EncoderBlock(nn.Module):
+    # Conv -> BN -> ReLU -> MaxPool, the conv output is kept for the skip connection so the BN
+    # is applied as a fused scale and shift, and the ReLU after the pooling (they commute)
+    def __init__(self, conv, bn):
+        super(_EncoderBlock, self).__init__()
+        scale, shift = _bn_affine(bn)
+        self.conv = copy.deepcopy(conv)
+        self.register_buffer('scale', scale.view(1, -1, 1, 1))
+        self.register_buffer('shift', shift.view(1, -1, 1, 1))
 
+    def forward(self, x):
+        skip = self.conv(x)
+        x = F.max_pool2d(torch.addcmul(self.shift, skip, self.scale), kernel_size=2, stride=2)
+        return torch.relu(x), skip
+
+class _DecoderBlock(nn.Module):
+    # ConvTranspose -> (+ skip) -> BN -> ReLU, with the BN folded into the transposed conv weights
+    # and the skip connection. Extra rows and columns (odd encoder sizes) only receive the bias
+    def __init__(self, conv_t, bn):
+        super(_DecoderBlock, self).__init__()
+        scale, shift = _bn_affine(bn)
+        self.register_buffer('weight', conv_t.weight.detach() * scale.view(1, -1, 1, 1))
+        self.register_buffer('bias', (conv_t.bias.detach() * scale + shift).view(1, -1, 1, 1))
+        self.register_buffer('scale', scale.view(1, -1, 1, 1))
+
+    def forward(self, x, skip):
+        x = F.conv_transpose2d(x, self.weight, stride=2)
+        x = F.pad(x, [0, skip.shape[3] - x.shape[3], 0, skip.shape[2] - x.shape[2]])
+        return torch.relu(torch.addcmul(x + self.bias, skip, self.scale))
+
+def _fold_conv_bn(conv, bn):
+    scale, shift = _bn_affine(bn)
+    folded = copy.deepcopy(conv)
+    folded.weight.data = conv.weight.detach() * scale.view(-1, 1, 1, 1)
+    folded.bias.data = conv.bias.detach() * scale + shift
+    return folded
+
+class FusedAutoencoder(nn.Module):
+    """Inference version of a trained _autoencoder, with the BatchNorms folded into the convolutions and
+    a static block structure that can be scripted and exported to ONNX."""
+
+    def __init__(self, model):
+        super(FusedAutoencoder, self).__init__()
+
+        model = model.eval()
+
+        self.encoder_blocks = nn.ModuleList([_EncoderBlock(block.conv, block.bn) for block in model.encoder_blocks])
+        self.decoder_blocks = nn.ModuleList([_DecoderBlock(block.conv_t, block.bn) for block in model.decoder_blocks])
+        # ReLU before the pixel shuffle, a permutation of the conv outputs
+        self.upsampling_convs = nn.ModuleList([copy.deepcopy(block[0]) for block in model.upsampling_blocks])
+        self.output_conv = _fold_conv_bn(model.output_block[0], model.output_block[1])
 
     def forward(self, x):
 
-        # Encoding (Convolutional Blocks - Downsampling)
-        output_shapes = []
-        res_x = []
+        skips: List[torch.Tensor] = []
+        for block in self.encoder_blocks:
+            x, skip = block(x)
+            skips.append(skip)
+
+        i = len(skips) - 1
+        for block in self.decoder_blocks:
+            x = block(x, skips[i])
+            i -= 1
+
+        for conv in self.upsampling_convs:
+            x = F.pixel_shuffle(torch.relu(conv(x)), 2)
+
+        return torch.relu(self.output_conv(x))
+
+def _eager_copy(model):
+    # CPU copy of an eager (not compiled) _autoencoder in eval mode, without data parallel wrapper
+    if isinstance(model, (nn.DataParallel, DistributedDataParallel)):
+        model = model.module
+    return copy.deepcopy(model).cpu().eval()
+
+def _benchmark_pass(model, x, train=False):
+    # Forward pass, and backward pass if train
+    with torch.set_grad_enabled(train):
+        outputs = model(x)
+        if train: outputs.mean().backward()
+
+def _cpu_latency(model, x, n_runs, train=False):
+    times = []
+    _benchmark_pass(model, x, train) # warm up
+    for _ in range(n_runs):
+        start = time.perf_counter()
+        _benchmark_pass(model, x, train)
+        times.append(time.perf_counter() - start)
+    return float(np.median(times))
+
+def export_autoencoder(model, path, input_size, atol=1e-4, n_runs=10):
+    """Exports the fused model to {path}.pt (frozen TorchScript) and {path}.onnx, checks it against the
+    eager model on a random input of input_size and returns the paths, max error and CPU latencies."""
+
+    model = _eager_copy(model)
+    fused = FusedAutoencoder(model).eval()
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+    x = torch.rand(input_size)
+    with torch.no_grad():
+        scripted = torch.jit.freeze(torch.jit.script(fused))
+        max_error = (model(x) - scripted(x)).abs().max().item()
+    assert max_error < atol, f'Exported model differs from the eager model by {max_error}'
+
+    scripted.save(f'{path}.pt')
+    torch.onnx.export(fused, x, f'{path}.onnx',
+                      input_names=['x_lr'],
+                      output_names=['output_hr'],
+                      dynamic_axes={'x_lr': {0: 'batch', 2: 'height', 3: 'width'},
+                                    'output_hr': {0: 'batch', 2: 'height', 3: 'width'}},
+                      opset_version=13)
+
+    results = {'torchscript_path': f'{path}.pt',
+               'onnx_path': f'{path}.onnx',
+               'max_error': max_error,
+               'eager_latency': _cpu_latency(model, x, n_runs),
+               'exported_latency': _cpu_latency(torch.jit.optimize_for_inference(scripted), x, n_runs)}
+    print(pd.Series(results))
 
-        for layer in self.encoder_layers:
-            if isinstance(layer, torch.nn.modules.pooling.MaxPool2d):
-                output_shapes.append(x.shape)
+    return results
 
-            x = layer(x)
+def benchmark_compile(h_channels, input_sizes, upscale_factor=1, n_runs=10):
+    """CPU latency of the eager and torch.compile (dynamic shapes) _autoencoder on inputs of each of
+    input_sizes (B, C, H, W), compiled once for all of them, for inference and for training steps
+    (forward and backward passes). compile_time is the latency of the first compiled call of a size."""
+
+    results = []
+    for mode in ['inference', 'train']:
+        model = _autoencoder(h_channels=h_channels, upscale_factor=upscale_factor).train(mode == 'train')
+        compiled_model = torch.compile(copy.deepcopy(model), dynamic=True)
+
+        for input_size in input_sizes:
+            x = torch.rand(input_size)
+            start = time.perf_counter()
+            _benchmark_pass(compiled_model, x, train=mode == 'train')
+            compile_time = time.perf_counter() - start
+            eager_latency = _cpu_latency(model, x, n_runs, train=mode == 'train')
+            compiled_latency = _cpu_latency(compiled_model, x, n_runs, train=mode == 'train')
+            results.append({'mode': mode,
+                            'input_size': tuple(input_size),
+                            'compile_time': compile_time,
+                            'eager_latency': eager_latency,
+                            'compiled_latency': compiled_latency,
+                            'speedup': eager_latency / compiled_latency})
+
+    results = pd.DataFrame(results)
+    print(results)
 
-            if isinstance(layer, torch.nn.modules.Conv2d): # skip connections
-                res_x.append(x)
+    return results
 
-        output_shapes = output_shapes[::-1]
-        res_x = res_x[::-1]
+# Cell
+class _QuantEncoderBlock(nn.Module):
+    def __init__(self, conv, bn):
+        super(_QuantEncoderBlock, self).__init__()
+        self.conv = copy.deepcopy(conv)
+        self.bn = copy.deepcopy(bn)
+        self.relu = nn.ReLU()
+        self.pool = nn.MaxPool2d(kernel_size=2, stride=2)
 
-        # Decoding (Transpose Convolutional Blocks - Upsampling)
-        for i, layer in enumerate(self.decoder_layers):
-            if isinstance(layer, torch.nn.modules.conv.ConvTranspose2d):
-                x = layer(x, output_size=output_shapes[i//3]) # if layer is ConvTranspose2D, then call it preserving output size from encoder
-                x += res_x[i//3] # skip connections
-            else:
-                x = layer(x)
+    def forward(self, x):
+        skip = self.conv(x)
+        return self.pool(self.relu(self.bn(skip))), skip
+
+class _QuantDecoderBlock(nn.Module):
+    def __init__(self, conv_t, bn):
+        super(_QuantDecoderBlock, self).__init__()
+        self.conv_t = copy.deepcopy(conv_t)
+        self.bn = copy.deepcopy(bn)
+        self.relu = nn.ReLU()
+        # Quantized add with its own observer for the skip connection
+        self.skip_add = nn.quantized.FloatFunctional()
+
+    def forward(self, x, skip):
+        return self.relu(self.bn(self.skip_add.add(self.conv_t(x), skip)))
+
+class QuantizedAutoencoder(nn.Module):
+    """Trained _autoencoder with quantization stubs, fused BN + ReLU and observed skip connection adds,
+    to be prepared and converted by quantize_autoencoder. Inputs are padded to a multiple of the
+    encoder downsampling so that the skip connections need no padding inside the int8 model."""
+
+    def __init__(self, model):
+        super(QuantizedAutoencoder, self).__init__()
+
+        model = model.eval()
+
+        self.quant = QuantStub()
+        self.dequant = DeQuantStub()
+
+        self.encoder_blocks = nn.ModuleList([_QuantEncoderBlock(block.conv, block.bn)
+                                             for block in model.encoder_blocks])
+        self.decoder_blocks = nn.ModuleList([_QuantDecoderBlock(block.conv_t, block.bn)
+                                             for block in model.decoder_blocks])
+        # ReLU before the pixel shuffle, a permutation of the conv outputs
+        self.upsampling_blocks = nn.ModuleList([nn.Sequential(copy.deepcopy(block[0]), nn.ReLU(),
+                                                              nn.PixelShuffle(upscale_factor=2))
+                                                for block in model.upsampling_blocks])
+        self.output_block = copy.deepcopy(model.output_block)
+
+        self.downsampling = 2 ** len(self.encoder_blocks)
+        self.upscale_factor = 2 ** len(self.upsampling_blocks)
+
+    def fuse(self):
+        for block in self.encoder_blocks:
+            torch.quantization.fuse_modules(block, [['bn', 'relu']], inplace=True)
+        for block in self.decoder_blocks:
+            torch.quantization.fuse_modules(block, [['bn', 'relu']], inplace=True)
+        for block in self.upsampling_blocks:
+            torch.quantization.fuse_modules(block, [['0', '1']], inplace=True)
+        torch.quantization.fuse_modules(self.output_block, [['0', '1', '2']], inplace=True)
+
+    def forward(self, x):
+
+        height, width = x.shape[2], x.shape[3]
+        x = F.pad(x, [0, (-width) % self.downsampling, 0, (-height) % self.downsampling], mode='replicate')
+        x = self.quant(x)
 
-        return x
+        skips: List[torch.Tensor] = []
+        for block in self.encoder_blocks:
+            x, skip = block(x)
+            skips.append(skip)
+
+        i = len(skips) - 1
+        for block in self.decoder_blocks:
+            x = block(x, skips[i])
+            i -= 1
+
+        for block in self.upsampling_blocks:
+            x = block(x)
+
+        x = self.dequant(self.output_block(x))
+        return x[:, :, :self.upscale_factor * height, :self.upscale_factor * width]
+
+def quantize_autoencoder(model, calibration_loader, path=None, n_batches=None, backend='fbgemm'):
+    """Post-training static int8 quantization of a trained _autoencoder for CPU inference, with activation
+    ranges calibrated on the LR pictures of calibration_loader. Saved as TorchScript to {path}.pt."""
+
+    model = _eager_copy(model)
+
+    torch.backends.quantized.engine = backend
+    quantized_model = QuantizedAutoencoder(model).eval()
+    quantized_model.fuse()
+
+    quantized_model.qconfig = torch.quantization.get_default_qconfig(backend)
+    # Per-tensor weights for the transposed convolutions, not supported per channel
+    for block in quantized_model.decoder_blocks:
+        block.conv_t.qconfig = QConfig(activation=quantized_model.qconfig.activation,
+                                       weight=default_weight_observer)
+    torch.quantization.prepare(quantized_model, inplace=True)
+
+    with torch.no_grad():
+        for batch_idx, (x_lr, _) in enumerate(tqdm(calibration_loader)):
+            if n_batches is not None and batch_idx >= n_batches: break
+            quantized_model(x_lr.float())
+
+    torch.quantization.convert(quantized_model, inplace=True)
+
+    if path is not None:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        torch.jit.freeze(torch.jit.script(quantized_model)).save(f'{path}.pt')
+
+    return quantized_model
+
+def quantization_report(model, quantized_model, loader, n_batches=None):
+    """PSNR, SSIM and CPU throughput (pictures/sec) of the fp32 and int8 models on loader."""
+
+    model = _eager_copy(model)
+
+    report = {}
+    for name, predictor in [('fp32', model), ('int8', quantized_model)]:
+        psnr = PSNR(data_range=1.0)
+        ssim = SSIM(data_range=1.0)
+        run_time = 0
+        n_pictures = 0
+
+        with torch.no_grad():
+            for batch_idx, (x_lr, target_hr) in enumerate(loader):
+                if n_batches is not None and batch_idx >= n_batches: break
+
+                start = time.perf_counter()
+                outputs = predictor(x_lr.float())
+                run_time += time.perf_counter() - start
+                n_pictures += x_lr.shape[0]
+
+                psnr.update((outputs, target_hr))
+                ssim.update((outputs, target_hr))
+
+        report[f'{name}_psnr'] = psnr.compute()
+        report[f'{name}_ssim'] = ssim.compute()
+        report[f'{name}_throughput'] = n_pictures / run_time
+
+    report['psnr_change'] = report['int8_psnr'] - report['fp32_psnr']
+    report['ssim_change'] = report['int8_ssim'] - report['fp32_ssim']
+    report['speedup'] = report['int8_throughput'] / report['fp32_throughput']
+    print(pd.Series(report))
+
+    return report
 
 
 # Cell
+class StepProfiler(object):
+    """Splits the wall time of each training step into phases (data wait, host to device copy,
+    forward, loss, backward, optimizer, scheduler...) and appends one json line per step to
+    log_path with the phase times, images/sec, pixels/sec and peak memory. Optionally records
+    a torch.profiler trace of trace_steps steps after trace_start steps."""
+
+    def __init__(self, log_path, device, enabled=True, trace_start=None, trace_steps=1, trace_dir=None):
+
+        self.log_path = log_path
+        self.device = device
+        self.enabled = enabled
+        self.trace = None
+        self.phases = {}
+        self.totals = {}
+        self.n_steps = 0
+
+        if not enabled: return
+
+        if os.path.dirname(log_path):
+            os.makedirs(os.path.dirname(log_path), exist_ok=True)
+        self.log_file = open(log_path, 'a')
+
+        if trace_start is not None:
+            trace_dir = trace_dir or os.path.dirname(log_path) or '.'
+            self.trace = torch.profiler.profile(
+                schedule=torch.profiler.schedule(wait=trace_start, warmup=1, active=trace_steps, repeat=1),
+                on_trace_ready=torch.profiler.tensorboard_trace_handler(trace_dir),
+                profile_memory=True)
+            self.trace.start()
+
+        self.last = time.perf_counter()
+
+    def start_epoch(self):
+        # Data wait of the first step starts when the loader iterator is created
+        if self.enabled: self.last = time.perf_counter()
+
+    def phase(self, name):
+        if not self.enabled: return
+
+        # Device work is asynchronous, it is attributed to the phase that launched it
+        if self.device.type == 'cuda': torch.cuda.synchronize()
+        now = time.perf_counter()
+        self.phases[name] = self.phases.get(name, 0) + now - self.last
+        self.last = now
+
+    def end_step(self, step, epoch, n_images, n_pixels):
+        if not self.enabled: return
+
+        step_time = sum(self.phases.values())
+        if self.device.type == 'cuda':
+            peak_memory = torch.cuda.max_memory_allocated(self.device) / 2**20
+        else:
+            peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+        record = {'step': step,
+                  'epoch': epoch,
+                  'step_time': step_time,
+                  **self.phases,
+                  'images_per_sec': n_images / step_time,
+                  'pixels_per_sec': n_pixels / step_time,
+                  'peak_memory_mb': peak_memory}
+        self.log_file.write(json.dumps(record) + '\n')
+
+        for name, value in self.phases.items():
+            self.totals[name] = self.totals.get(name, 0) + value
+        self.n_steps += 1
+        self.phases = {}
+
+        if self.trace is not None: self.trace.step()
+
+    def close(self):
+        if not self.enabled: return
+
+        if self.trace is not None: self.trace.stop()
+        self.log_file.close()
+
+        if self.n_steps > 0:
+            display_str = f'Mean step phases ({self.n_steps} steps): '
+            display_str += ' '.join(f'{name}: {value / self.n_steps:0.4f}' for name, value in self.totals.items())
+            print(display_str)
+
+# Cell
+class PNGWriter(object):
+    """Bounded pool of threads encoding and writing output pictures as PNG files."""
+
+    def __init__(self, num_workers=4, max_pending=16, compress_level=6):
+
+        self.compress_level = compress_level
+        self.executor = ThreadPoolExecutor(max_workers=num_workers)
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.futures = []
+
+    def write(self, pic, path):
+        Image.fromarray(pic).save(path, format='PNG', compress_level=self.compress_level)
+
+    def submit(self, pic, path):
+
+        # Same conversion as torchvision save_image, done before queueing so that
+        # the device tensor can be released
+        pic = pic.mul(255).add_(0.5).clamp_(0, 255).permute(1, 2, 0).to('cpu', torch.uint8).numpy()
+
+        # Errors of finished writes are raised here
+        for future in self.futures:
+            if future.done(): future.result()
+        self.futures = [future for future in self.futures if not future.done()]
+
+        self.slots.acquire()
+        future = self.executor.submit(self.write, pic, path)
+        future.add_done_callback(lambda _: self.slots.release())
+        self.futures.append(future)
+
+    def close(self):
+        for future in self.futures:
+            future.result()
+        self.futures = []
+        self.executor.shutdown()
+
+# Cell
+def _atomic_write(data, path):
+    # Written next to the destination and renamed, readers never see a partial file. The temporary
+    # file is unique, concurrent writers of the same path do not overwrite each other's data
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+class Checkpointer(object):
+    """Training checkpoints of one run in checkpoint_dir, serialized on a background thread from a CPU
+    copy of the state. Keeps last.pth to resume, best.pth and the top_k checkpoints by val_ssim, and
+    marks finished runs with a complete file."""
+
+    def __init__(self, checkpoint_dir, top_k=3, resume=False):
+
+        self.checkpoint_dir = checkpoint_dir
+        self.top_k = top_k
+        self.last_path = f'{checkpoint_dir}/last.pth'
+        self.best_path = f'{checkpoint_dir}/best.pth'
+        self.index_path = f'{checkpoint_dir}/top_k.json'
+        self.complete_path = f'{checkpoint_dir}/complete'
+
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.future = None
+
+        # Created by every process of a distributed run
+        os.makedirs(checkpoint_dir, exist_ok=True)
+
+        # [val_ssim, step] of the kept checkpoints, best first, only continued when resuming the run
+        self.kept = []
+        if resume and os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                self.kept = json.load(f)
+
+    def step_path(self, step):
+        return f'{self.checkpoint_dir}/step_{step}.pth'
+
+    def snapshot(self, state):
+        # Device tensors are copied, training can update them while the state is written
+        if torch.is_tensor(state):
+            return state.detach().to('cpu', copy=True)
+        if isinstance(state, dict):
+            return {k: self.snapshot(v) for k, v in state.items()}
+        if isinstance(state, list):
+            return [self.snapshot(v) for v in state]
+        return copy.deepcopy(state)
+
+    def write(self, state, step, val_ssim):
+
+        buffer = io.BytesIO()
+        torch.save(state, buffer)
+        data = buffer.getvalue()
+
+        kept = sorted(self.kept + [[val_ssim, step]], reverse=True)[:self.top_k]
+
+        _atomic_write(data, self.last_path)
+        if [val_ssim, step] in kept:
+            _atomic_write(data, self.step_path(step))
+        if kept[0] == [val_ssim, step]:
+            _atomic_write(data, self.best_path)
+
+        for _, old_step in self.kept:
+            if old_step not in [kept_step for _, kept_step in kept] and os.path.exists(self.step_path(old_step)):
+                os.remove(self.step_path(old_step))
+
+        self.kept = kept
+        _atomic_write(json.dumps(kept).encode(), self.index_path)
+
+    def save(self, state, step, val_ssim):
+
+        state = self.snapshot(state)
+        val_ssim = float(val_ssim)
+
+        # At most one checkpoint pending, errors of the previous write are raised here
+        if self.future is not None:
+            self.future.result()
+        self.future = self.executor.submit(self.write, state, step, val_ssim)
+
+    def load_last(self):
+        if not os.path.exists(self.last_path): return None
+        # Checkpoints hold the numpy and python RNG states, not only tensors
+        return torch.load(self.last_path, map_location='cpu', weights_only=False)
+
+    def close(self):
+        if self.future is not None:
+            self.future.result()
+        self.future = None
+        self.executor.shutdown()
+
+    def mark_complete(self):
+        # Written once the last checkpoint is, runs without it were interrupted
+        _atomic_write(b'', self.complete_path)
+
+def _checkpoint_dir(params, run_id):
+    # Each run writes to its own directory {path stem}/{trial key}/{run_id}. resume=True continues the
+    # latest unfinished run of the same trial key with a last.pth, finished runs are trained again in a
+    # new directory. resume can also be the directory of a run. Returns the directory and whether the
+    # run is resumed
+    key_dir = f"{os.path.splitext(params['path'])[0]}/{trial_key(params)}"
+    resume = params.get('resume', False)
+    if isinstance(resume, str):
+        return resume, True
+    if resume:
+        runs = [run for run in glob.glob(f'{key_dir}/*/last.pth')
+                if not os.path.exists(f'{os.path.dirname(run)}/complete')]
+        runs = sorted(runs, key=os.path.getmtime)
+        if len(runs) > 0: return os.path.dirname(runs[-1]), True
+    return f'{key_dir}/{run_id}', False
+
+# Cell
+def _is_out_of_memory(error):
+    return isinstance(error, RuntimeError) and 'out of memory' in str(error)
+
+def _process_status(field):
+    # Value in bytes of a kB field of /proc/self/status (VmRSS, VmHWM)
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(f'{field}:'):
+                return int(line.split()[1]) * 1024
+
+def _peak_memory(model, input_size, micro_batch_size, device, autocast, n_passes,
+                 memory_format=torch.contiguous_format):
+    # Peak memory (bytes) of synthetic forward/backward passes. On CPU the growth of the resident set
+    # size during the passes plus the parameters, memory held before (datasets, earlier trials) does
+    # not count. Writing 5 to clear_refs resets the peak (VmHWM) to the current resident set size
+    x = torch.rand((micro_batch_size,) + tuple(input_size), device=device).to(memory_format=memory_format)
+    if device.type == 'cuda':
+        torch.cuda.empty_cache()
+        torch.cuda.reset_peak_memory_stats(device)
+    else:
+        gc.collect()
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        resident_memory = _process_status('VmRSS')
+
+    model.train()
+    for _ in range(n_passes):
+        with autocast():
+            outputs = model(x)
+        outputs.float().mean().backward()
+        del outputs
+    model.zero_grad(set_to_none=True)
+
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device)
+    param_bytes = sum(p.numel() * p.element_size() for p in model.parameters())
+    return _process_status('VmHWM') - resident_memory + param_bytes
+
+def plan_micro_batch(model, input_size, batch_size, memory_budget, device, model_statistics=None,
+                     autocast=contextlib.nullcontext, n_passes=2, memory_format=torch.contiguous_format):
+    """Largest divisor of batch_size whose synthetic forward/backward passes of model on inputs of
+    input_size (C, H, W) stay within memory_budget bytes, optimizer states included. Candidates above the
+    estimate from the torchinfo model_statistics (computed for batch_size) are not run, model_statistics
+    is None when activations are recomputed instead of kept."""
+
+    # The synthetic passes update the BatchNorm running statistics
+    state_dict = copy.deepcopy(model.state_dict())
+
+    candidates = [size for size in range(1, batch_size + 1) if batch_size % size == 0]
+    param_bytes = sum(p.numel() * p.element_size() for p in model.parameters())
+
+    if model_statistics is not None:
+        sample_bytes = (model_statistics.total_input + model_statistics.total_output_bytes) / batch_size
+        candidates = [size for size in candidates if 4 * param_bytes + size * sample_bytes <= memory_budget]
+
+    micro_batch_size = None
+    for size in candidates:
+        try:
+            # AdamW keeps two more copies of the parameters, not allocated before the first step
+            peak_memory = _peak_memory(model, input_size, size, device, autocast, n_passes,
+                                       memory_format) + 2 * param_bytes
+        except RuntimeError as error:
+            if not _is_out_of_memory(error): raise
+            model.zero_grad(set_to_none=True)
+            break
+        if peak_memory > memory_budget: break
+        micro_batch_size = size
+
+    model.load_state_dict(state_dict)
+    if device.type == 'cuda':
+        torch.cuda.empty_cache()
+
+    if micro_batch_size is None:
+        raise MemoryError(f'A single sample of size {input_size} does not fit in {memory_budget} bytes')
+    return micro_batch_size
+
+# Cell
+def _amp_dtype(precision, device):
+    # Autocast dtype of a precision policy, None for fp32. 'auto' is fp16 on GPUs and bf16 on CPU
+    assert precision in ['fp32', 'fp16', 'bf16', 'auto'], f'Unknown precision {precision}'
+    if precision == 'auto':
+        precision = 'fp16' if device.type == 'cuda' else 'bf16'
+    return {'fp32': None, 'fp16': torch.float16, 'bf16': torch.bfloat16}[precision]
+
+def _feather_window(length, overlap):
+    # Linear ramps over the overlap at both ends, strictly positive so that the borders of
+    # the picture (covered by a single tile) keep their value after normalization
+    window = torch.ones(length)
+    overlap = min(overlap, length // 2)
+    if overlap > 0:
+        ramp = torch.arange(1, overlap + 1, dtype=torch.float32) / (overlap + 1)
+        window[:overlap] = ramp
+        window[-overlap:] = ramp.flip(0)
+    return window
+
 class autoencoder(object):
 
     def __init__(self, params):
@@ -461,20 +1576,77 @@ class autoencoder(object):
         super().__init__()
         self.params = params
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        self.rank = _rank()
 
         # Instantiate model
 
         #------------------------------------ Model & Optimizer ----------------------------------#
 
-        self.model = _autoencoder(h_channels=params['h_channels'])
-
-        print(summary(self.model,
-                      input_size=(params['batch_size'],
-                                  3,
-                                  params['final_size'],
-                                  params['final_size'])))
-
-        self.model = nn.DataParallel(self.model).to(self.device)
+        self.upscale_factor = 4 if params.get('native_lr', False) else 1
+        self.model = _autoencoder(h_channels=params['h_channels'],
+                                  upscale_factor=self.upscale_factor,
+                                  checkpoint_blocks=params.get('checkpoint_blocks', None))
+
+        # Precision policy and memory format, shared by fit, evaluate_performance and predict_labels
+        self.amp_dtype = _amp_dtype(params.get('precision', 'fp32'), self.device)
+        self.memory_format = torch.channels_last if params.get('channels_last', False) \
+                             else torch.contiguous_format
+
+        input_size = (params.get('patch_size', None) or params['final_size']) // self.upscale_factor
+        batch_size = params['batch_size'] * params.get('patches_per_image', 1)
+        model_statistics = summary(self.model,
+                                   input_size=(batch_size,
+                                               3,
+                                               input_size,
+                                               input_size),
+                                   verbose=0)
+        if self.rank == 0:
+            print(model_statistics)
+
+        self.model = self.model.to(self.device, memory_format=self.memory_format)
+
+        # Largest micro-batch within memory_budget bytes, fit reaches batch_size by gradient accumulation.
+        # Planned on the bare module, the forward passes of DistributedDataParallel synchronize the
+        # processes. Every process takes the smallest plan, they accumulate the same number of micro-batches
+        self.micro_batch_size = batch_size
+        if params.get('memory_budget', None) is not None:
+            self.micro_batch_size = plan_micro_batch(self.model,
+                                                     input_size=(3, input_size, input_size),
+                                                     batch_size=batch_size,
+                                                     memory_budget=params['memory_budget'],
+                                                     device=self.device,
+                                                     # torchinfo counts the activations of every block,
+                                                     # checkpointed blocks only keep their inputs
+                                                     model_statistics=None if params.get('checkpoint_blocks', None) \
+                                                                      else model_statistics,
+                                                     autocast=self.autocast,
+                                                     memory_format=self.memory_format)
+            self.micro_batch_size = _all_reduce_min(self.micro_batch_size, self.device)
+            if self.rank == 0:
+                print(f'micro_batch_size: {self.micro_batch_size} '
+                      f'accumulation_steps: {batch_size // self.micro_batch_size}')
+
+        # The exports and the quantization start from the eager module
+        self.eager_model = self.model
+
+        # Compiled by default with dynamic shapes for test pictures of varying size, benchmark_compile on CPU
+        # gives 1.4 to 1.6 times faster forward and backward passes and 2.5 to 3 times faster inference,
+        # after about a minute of compilation. A shallow copy of the eager module is compiled in place, it shares its parameters,
+        # buffers and submodules and the state_dict keeps its keys. DataParallel replicas over several GPUs
+        # would call the eager module
+        if params.get('compile', True) and hasattr(nn.Module, 'compile') and \
+           (dist.is_initialized() or torch.cuda.device_count() <= 1):
+            self.model = copy.copy(self.model)
+            self.model.compile(dynamic=True)
+
+        # One process per device (or group of CPU cores) under torchrun, gradients are all-reduced
+        # during the backward pass
+        if dist.is_initialized():
+            self.model = DistributedDataParallel(self.model,
+                                                 device_ids=[torch.cuda.current_device()] \
+                                                            if torch.cuda.is_available() else None)
+        else:
+            self.model = nn.DataParallel(self.model).to(self.device)
 
         self.optimizer = AdamW(self.model.parameters(),
                                lr=params['initial_lr'],
@@ -482,10 +1654,18 @@ class autoencoder(object):
                                                                     # the fit method to also save
                                                                     # the optimizer state_dict.
 
-        self.psnr = PSNR(data_range=1.0)
-        self.ssim = SSIM(data_range=1.0)
+        # ignite metrics are reduced over the processes when the process group is initialized
+        self.psnr = PSNR(data_range=1.0, device=self.device)
+        self.ssim = SSIM(data_range=1.0, device=self.device)
+
+        # Train metrics accumulated during the optimization pass
+        self.running_psnr = PSNR(data_range=1.0, device=self.device)
+        self.running_ssim = SSIM(data_range=1.0, device=self.device)
 
-    def fit(self, train_loader, val_loader):
+        # TorchScript model from export_autoencoder, used by predict_labels if loaded
+        self.inference_model = None
+
+    def fit(self, train_loader, val_loader, pruner=None):
 
         params = self.params
 
@@ -497,7 +1677,7 @@ class autoencoder(object):
 
         #------------------------------------- Optimization --------------------------------------#
         if params['criterion'] == 'ssim':
-            cirterion = pytorch_ssim.SSIM()
+            criterion = pytorch_ssim.SSIM(band_size=params.get('ssim_band_size', None))
         else:
             criterion = nn.MSELoss()
 
@@ -506,13 +1686,43 @@ class autoencoder(object):
                                                     step_size=params['adjust_lr_step'],
                                                     gamma=params['lr_decay'])
 
-        scaler = torch.cuda.amp.GradScaler()
+        # Loss scaling only for fp16, bf16 has the range of fp32
+        scaler = torch.cuda.amp.GradScaler(enabled=self.amp_dtype == torch.float16 and self.device.type == 'cuda')
+
+        # Data augmentation applied on the device to whole batches
+        if params.get('batch_augmentation', False):
+            augmentation_generator = torch.Generator().manual_seed(params['random_seed'] + self.rank)
+
+        profiler = StepProfiler(log_path=f'./results/{params["experiment_id"]}/{self.time_stamp}_steps.jsonl',
+                                device=self.device,
+                                enabled=params.get('profile_steps', False) and self.rank == 0,
+                                trace_start=params.get('profile_trace_start', None),
+                                trace_steps=params.get('profile_trace_steps', 1))
+
+        # Fixed subsets of the train (without augmentation) and validation sets, preprocessed once
+        if params.get('eval_subset_size', None):
+            train_eval_loader = self.cached_subset(train_loader, params['eval_subset_size'], augmentation=False)
+            val_eval_loader = self.cached_subset(val_loader, params['eval_subset_size'])
+        else:
+            train_eval_loader = train_loader
+            val_eval_loader = val_loader
+
+        # Checkpoints of this run, the directory chosen by rank 0 is used by every process
+        run_id = f'{int(self.time_stamp * 1e6)}_{os.getpid()}'
+        checkpoint_dir, resume = _broadcast_object(_checkpoint_dir(params, run_id))
+        checkpointer = Checkpointer(checkpoint_dir=checkpoint_dir,
+                                    top_k=params.get('checkpoint_top_k', 3),
+                                    resume=resume)
 
         #---------------------------------------- Logging -----------------------------------------#
         step = 0
         epoch = 0
         break_flag = False
         self.best_ssim = 0
+        self.pruned = False
+
+        running_loss = 0
+        running_steps = 0
 
         trajectories = {'step':  [],
                         'epoch':  [],
@@ -523,6 +1733,27 @@ class autoencoder(object):
                         'train_ssim': [],
                         'val_ssim': []}
 
+        # Checkpoints are taken at the end of an epoch, after the evaluation, restoring the RNG
+        # states there gives the same shuffling, worker seeds and augmentations as the original run.
+        # Each process restores its own states, the run is resumed with the same number of processes
+        checkpoint = checkpointer.load_last() if resume else None
+        if checkpoint is not None:
+            print(f'Resuming from {checkpointer.last_path} (step: {checkpoint["step"]})')
+            step = checkpoint['step']
+            epoch = checkpoint['epoch']
+            self.best_ssim = checkpoint['best_ssim']
+            self.checkpoint_path = checkpointer.best_path
+            trajectories = checkpoint['trajectories']
+            self.model.load_state_dict(checkpoint['model_state_dict'])
+            self.optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+            scheduler.load_state_dict(checkpoint['scheduler_state_dict'])
+            scaler.load_state_dict(checkpoint['scaler_state_dict'])
+            assert len(checkpoint['rng_states']) == _world_size(), \
+                f'Run of {len(checkpoint["rng_states"])} processes resumed with {_world_size()}'
+            self.set_rng_state(checkpoint['rng_states'][self.rank])
+            if params.get('batch_augmentation', False):
+                augmentation_generator.set_state(checkpoint['augmentation_rng_states'][self.rank])
+
         print('\n'+'='*43+' Fitting  Autoencoder Model '+'='*43)
 
         while step <= params['iterations']:
@@ -532,6 +1763,11 @@ class autoencoder(object):
             self.model.train()
 
             start_epoch = time.time()
+            profiler.start_epoch()
+
+            # Shuffling of the train shards, from the seed and epoch
+            if isinstance(train_loader.sampler, DistributedSampler):
+                train_loader.sampler.set_epoch(epoch)
 
             for batch_idx, (x_lr, target_hr) in enumerate(train_loader):
 
@@ -540,33 +1776,90 @@ class autoencoder(object):
                 if break_flag: # weird epoch breaker
                     continue
 
+                profiler.phase('data_wait')
+
                 #--------------------------------- Forward and Backward ---------------------------------#
-                x_lr = x_lr.to(self.device)
-                target_hr = target_hr.to(self.device)
+                # Augmentation matrices of the whole batch drawn on CPU as augment_batch does, each
+                # micro-batch is warped once on the device
+                thetas = [None] * len(x_lr.split(self.micro_batch_size))
+                if params.get('batch_augmentation', False):
+                    thetas = _augmentation_theta(*_augmentation_params(x_lr.shape[0], params['data_augmentation'],
+                                                                       augmentation_generator),
+                                                 height=target_hr.shape[2], width=target_hr.shape[3])
+                    thetas = thetas.split(self.micro_batch_size)
 
                 self.optimizer.zero_grad()
 
-                with torch.cuda.amp.autocast():
+                # Gradients accumulated over micro-batches of micro_batch_size, one optimizer step per batch.
+                # Only a micro-batch is on the device at a time, as in the passes of plan_micro_batch
+                micro_batches = list(zip(x_lr.split(self.micro_batch_size), target_hr.split(self.micro_batch_size),
+                                         thetas))
+                loss = 0
+                for k, (x_micro, target_micro, theta) in enumerate(micro_batches):
+
+                    x_micro = x_micro.to(self.device)
+                    target_micro = target_micro.to(self.device)
+                    profiler.phase('host_to_device')
 
-                    outputs = self.model(x_lr.float())
+                    if theta is not None:
+                        x_micro, target_micro = _warp_batch(x_micro.float(), target_micro.float(), theta,
+                                                            interpolation=params['interpolation'])
+                        profiler.phase('augmentation')
 
+                    with self.autocast():
 
+                        outputs = self.model(x_micro.float().contiguous(memory_format=self.memory_format))
+                        profiler.phase('forward')
+
+                    # Loss in fp32, weighted by the share of the micro-batch in the batch
+                    outputs = outputs.float()
                     if params['criterion'] == 'ssim':
-                        loss = -criterion(outputs, target_hr)
+                        micro_loss = -criterion(outputs, target_micro)
                     else:
-                        loss = criterion(outputs, target_hr)
+                        micro_loss = criterion(outputs, target_micro)
+                    micro_loss = micro_loss * x_micro.shape[0] / x_lr.shape[0]
+                    profiler.phase('loss')
+
+                    # Gradients are all-reduced once, with the last micro-batch
+                    sync_context = self.model.no_sync() \
+                                   if isinstance(self.model, DistributedDataParallel) and k < len(micro_batches) - 1 \
+                                   else contextlib.nullcontext()
+                    with sync_context:
+                        scaler.scale(micro_loss).backward()
+                    profiler.phase('backward')
+
+                    loss += micro_loss.detach()
+
+                    if params.get('running_train_metrics', False):
+                        with torch.no_grad():
+                            self.running_psnr.update((outputs.detach().float(), target_micro))
+                            self.running_ssim.update((outputs.detach().float(), target_micro))
+                        profiler.phase('running_metrics')
 
-                    scaler.scale(loss).backward()
-                    scaler.step(self.optimizer)
-                    # Update optimizer learning rate
-                    scaler.update()
+                    del outputs, x_micro, target_micro
+
+                scaler.step(self.optimizer)
+                # Update optimizer learning rate
+                scaler.update()
+                profiler.phase('optimizer')
+
+                if params.get('running_train_metrics', False):
+                    running_loss += loss.float()
+                    running_steps += 1
+
+                n_images = target_hr.shape[0]
+                n_pixels = target_hr[:, 0].numel()
 
                 del x_lr
                 del target_hr
-                del outputs
+                del micro_batches
                 torch.cuda.empty_cache()
+                profiler.phase('cleanup')
 
                 scheduler.step()
+                profiler.phase('scheduler')
+
+                profiler.end_step(step=step, epoch=epoch, n_images=n_images, n_pixels=n_pixels)
 
             time_epoch = time.time() - start_epoch
 
@@ -575,10 +1868,21 @@ class autoencoder(object):
 
                 start_eval = time.time()
 
-                train_loss, train_psnr, train_ssim = \
-                    self.evaluate_performance(train_loader, criterion)
+                if params.get('running_train_metrics', False) and running_steps > 0:
+                    train_loss = _all_reduce_mean(running_loss.item() / (running_steps * params['batch_size']),
+                                                  self.device)
+                    train_psnr = self.running_psnr.compute()
+                    train_ssim = self.running_ssim.compute()
+
+                    running_loss = 0
+                    running_steps = 0
+                    self.running_psnr.reset()
+                    self.running_ssim.reset()
+                else:
+                    train_loss, train_psnr, train_ssim = \
+                        self.evaluate_performance(train_eval_loader, criterion)
                 val_loss, val_psnr, val_ssim = \
-                    self.evaluate_performance(val_loader, criterion)
+                    self.evaluate_performance(val_eval_loader, criterion)
 
                 time_eval = time.time() - start_eval
 
@@ -590,7 +1894,14 @@ class autoencoder(object):
                 display_str += f'train_psnr: {train_psnr:0.2f} train_ssim: {train_ssim:0.2f} '
                 display_str += f'val_psnr: {val_psnr:0.2f} val_ssim: {val_ssim:0.2f}'
 
-                print(display_str)
+                if self.rank == 0:
+                    print(display_str)
+
+                # Preprocessing latencies of the train set since the last display step
+                if train_loader.dataset.stage_timings is not None and self.rank == 0:
+                    for stage, stats in train_loader.dataset.stage_timings.summary().items():
+                        print(f'{stage}: ' + ' '.join(f'{k}: {v:0.4f}' for k, v in stats.items()))
+                    train_loader.dataset.stage_timings.reset()
 
                 trajectories['train_loss'] += [train_loss]
                 trajectories['val_loss']   += [val_loss]
@@ -600,24 +1911,50 @@ class autoencoder(object):
                 trajectories['val_ssim']   += [val_ssim]
 
                 if val_ssim > self.best_ssim:
-
-                    path = f"./checkpoint/{args.experiment_id}_{self.time_stamp}_ckpt.pth"
-                    print(f'Saving to {path}')
+                    if self.rank == 0:
+                        print(f'Saving to {checkpointer.best_path}')
                     self.best_ssim = val_ssim
-                    self.save_weights(path=path,
-                                      epoch=epoch,
-                                      train_loss=train_loss,
-                                      val_loss=val_loss,
-                                      train_psnr=train_psnr,
-                                      val_psnr=val_psnr,
-                                      train_ssim=train_ssim,
-                                      val_ssim=val_ssim)
+                    self.checkpoint_path = checkpointer.best_path
+
+                # Same weights on every process, only the first one writes checkpoints with the RNG
+                # states of every process
+                rng_states = _all_gather_object(self.get_rng_state())
+                augmentation_rng_states = _all_gather_object(augmentation_generator.get_state()) \
+                                          if params.get('batch_augmentation', False) else None
+                if self.rank == 0:
+                    checkpointer.save({'step': step,
+                                       'epoch': epoch,
+                                       'best_ssim': self.best_ssim,
+                                       'trajectories': trajectories,
+                                       'model_state_dict': self.model.state_dict(),
+                                       'optimizer_state_dict': self.optimizer.state_dict(),
+                                       'scheduler_state_dict': scheduler.state_dict(),
+                                       'scaler_state_dict': scaler.state_dict(),
+                                       'rng_states': rng_states,
+                                       'augmentation_rng_states': augmentation_rng_states,
+                                       'train_loss': train_loss,
+                                       'val_loss': val_loss,
+                                       'train_psnr': train_psnr,
+                                       'val_psnr': val_psnr,
+                                       'train_ssim': train_ssim,
+                                       'val_ssim': val_ssim},
+                                      step=step, val_ssim=val_ssim)
+
+                # Hopeless trials stop here and report their partial trajectories
+                if pruner is not None and pruner.should_prune(trajectories['val_ssim']):
+                    print(f'Pruning trial at step {step}, best val_ssim: {self.best_ssim:0.2f}')
+                    self.pruned = True
+                    break
 
             if step > params['iterations']:
                 break_flag=True
 
         #---------------------------------------- Final Logs -----------------------------------------#
         print('\n'+'='*43+' Finished Train '+'='*43)
+        profiler.close()
+        checkpointer.close()
+        if self.rank == 0:
+            checkpointer.mark_complete()
         self.train_loss = trajectories['train_loss'][-1]
         self.val_loss = trajectories['val_loss'][-1]
         self.train_psnr = trajectories['train_psnr'][-1]
@@ -639,7 +1976,9 @@ class autoencoder(object):
                 x_lr = x_lr.to(self.device)
                 target_hr = target_hr.to(self.device)
 
-                outputs = self.model(x_lr.float())
+                with self.autocast():
+                    outputs = self.model(x_lr.float().contiguous(memory_format=self.memory_format))
+                outputs = outputs.float()
                 loss = criterion(outputs, target_hr)
 
                 running_loss += loss.item()
@@ -653,6 +1992,7 @@ class autoencoder(object):
                 torch.cuda.empty_cache()
 
         running_loss /= len(loader) * params['batch_size']
+        running_loss = _all_reduce_mean(running_loss, self.device)
         psnr_score = self.psnr.compute()
         ssim_score = self.ssim.compute()
 
@@ -663,37 +2003,111 @@ class autoencoder(object):
 
         return running_loss, psnr_score, ssim_score
 
+    def cached_subset(self, loader, size, augmentation=True):
+        """Batches of a fixed random subset (random_seed) of the dataset of loader, computed once
+        and kept in memory to be passed to evaluate_performance instead of the loader."""
+
+        dataset = loader.dataset
+        if not augmentation:
+            dataset = copy.copy(dataset)
+            dataset.data_augmentation = None
+
+        generator = torch.Generator().manual_seed(self.params['random_seed'])
+        indices = torch.randperm(len(dataset), generator=generator)[:size].tolist()
+
+        subset_loader = DataLoader(Subset(dataset, indices),
+                                   shuffle=False,
+                                   batch_size=loader.batch_size,
+                                   num_workers=loader.num_workers,
+                                   collate_fn=loader.collate_fn,
+                                   drop_last=False)
+
+        return [batch for batch in subset_loader]
+
+    def export(self, path, input_size=None):
+        if input_size is None:
+            size = (self.params.get('patch_size', None) or self.params['final_size']) // self.upscale_factor
+            input_size = (1, 3, size, size)
+        return export_autoencoder(self.eager_model, path, input_size=input_size)
+
+    def quantize(self, path, val_loader, n_batches=None):
+        quantized_model = quantize_autoencoder(self.eager_model, val_loader, path=path, n_batches=n_batches)
+        return quantization_report(self.eager_model, quantized_model, val_loader, n_batches=n_batches)
+
+    def load_exported(self, path):
+        self.inference_model = torch.jit.load(path, map_location=self.device)
+        # int8 models already run quantized kernels, only float models get the CPU graph optimizations
+        if self.device.type == 'cpu' and 'quantized::' not in str(self.inference_model.inlined_graph):
+            self.inference_model = torch.jit.optimize_for_inference(self.inference_model)
+
+    def autocast(self):
+        return torch.autocast(device_type=self.device.type, dtype=self.amp_dtype, enabled=self.amp_dtype is not None)
+
+    def infer(self, x):
+        # Exported models keep the precision they were exported with
+        if self.inference_model is not None:
+            return self.inference_model(x)
+        with self.autocast():
+            outputs = self.model(x.contiguous(memory_format=self.memory_format))
+        return outputs.float()
+
     def predict_labels(self, loader):
 
         self.model.eval()
+        params = self.params
+
+        if params.get('inference_model', None) is not None and self.inference_model is None:
+            self.load_exported(params['inference_model'])
 
         files = [f.split('/')[-1] for f in loader.dataset.file_names_lr]
 
+        pic_set = loader.dataset.data_dir.split('/')[-1]
+        results_path = f'./results/{params["experiment_id"]}/test/{pic_set}'
+        if not os.path.exists(results_path):
+            os.makedirs(results_path)
+
+        # PNG encoding and writing in background threads, the model only waits if
+        # writer_max_pending pictures are already queued
+        writer = PNGWriter(num_workers=params.get('writer_workers', 4),
+                           max_pending=params.get('writer_max_pending', 16),
+                           compress_level=params.get('png_compress_level', 6))
+
+        pic_idx = 0
         with torch.no_grad():
             for batch_idx, (x_lr, x_lr_size, x_lr_norm_params) in tqdm(enumerate(loader)):
 
-                x_lr = x_lr.to(self.device)
-                x_lr_size['heights'] = 4 * x_lr_size['heights'].to(self.device)
-                x_lr_size['widths'] = 4 * x_lr_size['widths'].to(self.device)
-
-                x_lr_norm_params['stds'] = x_lr_norm_params['stds'].to(self.device)
-                x_lr_norm_params['means'] = x_lr_norm_params['means'].to(self.device)
+                # Tiles of each picture at its own size, output already at the target size
+                if params.get('tile_size', None):
+                    outputs = [self.predict_tiled(pic_lr,
+                                                  tile_size=params['tile_size'],
+                                                  tile_overlap=params.get('tile_overlap', 0),
+                                                  tile_batch_size=params.get('tile_batch_size', 8))
+                               for pic_lr in x_lr]
 
-                outputs = self.model(x_lr.float())
+                else:
+                    x_lr = x_lr.to(self.device)
+                    outputs = self.infer(x_lr.float())
 
-                output_hr = TF.resize(outputs[0],
-                                      size=[x_lr_size['heights'][0].item(),
-                                            x_lr_size['widths'][0].item()],
-                                      interpolation=TF.InterpolationMode.BICUBIC)
+                for k in range(len(outputs)):
+                    output_hr = outputs[k]
 
-                pic_set = loader.dataset.data_dir.split('/')[-1]
+                    if not params.get('tile_size', None):
+                        output_hr = TF.resize(output_hr,
+                                              size=[4 * x_lr_size['heights'][k].item(),
+                                                    4 * x_lr_size['widths'][k].item()],
+                                              interpolation=TF.InterpolationMode.BICUBIC)
 
-                results_path = f'./results/{self.params["experiment_id"]}/test/{pic_set}'
+                    # PicturesDatasetTest pictures are never normalized nor flipped
+                    if getattr(loader.dataset, 'normalize', False):
+                        stds = x_lr_norm_params['stds'][k].to(output_hr.device)
+                        means = x_lr_norm_params['means'][k].to(output_hr.device)
+                        output_hr = output_hr * stds.view(-1, 1, 1) + means.view(-1, 1, 1)
 
-                if not os.path.exists(results_path):
-                    os.makedirs(results_path)
+                    if 'flipped' in x_lr_size and x_lr_size['flipped'][k]:
+                        output_hr = output_hr.transpose(1, 2)
 
-                save_image(output_hr, f'{results_path}/{files[batch_idx]}')
+                    writer.submit(output_hr, f'{results_path}/{files[pic_idx]}')
+                    pic_idx += 1
 
                 # Clean memory
                 del x_lr
@@ -702,6 +2116,56 @@ class autoencoder(object):
                 del outputs
                 torch.cuda.empty_cache()
 
+        writer.close()
+
+    def predict_tiled(self, x_lr, tile_size, tile_overlap, tile_batch_size=8):
+        """Runs the model over overlapping tiles of one picture (3, H, W), in batches of
+        tile_batch_size, and blends them with a feathered window. tile_size and tile_overlap
+        are in output pixels. The output is accumulated on CPU at the target size."""
+
+        # Tiles and their starts are multiples of the downsampling factor of the model, so that the
+        # pooling windows of a tile are the ones of the full picture and, away from the seams, the tiles
+        # give the full-frame output. The last tiles go past the picture, padded with zeros
+        scale = self.upscale_factor
+        multiple = 2 ** len(self.params['h_channels'])
+        _, pic_h, pic_w = x_lr.shape
+        overlap = tile_overlap // scale
+
+        def tile_length(length):
+            length = -(-length // multiple) * multiple
+            return max(min(tile_size // scale, length) // multiple * multiple, multiple)
+
+        def tile_starts(length, tile_length):
+            stride = max((tile_length - overlap) // multiple * multiple, multiple)
+            return list(range(0, length - tile_length + stride, stride))
+
+        tile_h, tile_w = tile_length(pic_h), tile_length(pic_w)
+        starts_h, starts_w = tile_starts(pic_h, tile_h), tile_starts(pic_w, tile_w)
+        padded_h, padded_w = starts_h[-1] + tile_h, starts_w[-1] + tile_w
+        x_lr = F.pad(x_lr, (0, padded_w - pic_w, 0, padded_h - pic_h))
+
+        window = _feather_window(scale * tile_h, scale * overlap).unsqueeze(1) * \
+                 _feather_window(scale * tile_w, scale * overlap).unsqueeze(0)
+
+        output_hr = torch.zeros(3, scale * padded_h, scale * padded_w)
+        weights = torch.zeros(1, scale * padded_h, scale * padded_w)
+
+        corners = [(i, j) for i in starts_h for j in starts_w]
+        for b in range(0, len(corners), tile_batch_size):
+            batch_corners = corners[b:b + tile_batch_size]
+            tiles = torch.stack([x_lr[:, i:i + tile_h, j:j + tile_w] for i, j in batch_corners])
+
+            outputs = self.infer(tiles.to(self.device).float()).float().cpu()
+
+            for (i, j), output in zip(batch_corners, outputs):
+                output_hr[:, scale*i:scale*(i + tile_h), scale*j:scale*(j + tile_w)] += output * window
+                weights[:, scale*i:scale*(i + tile_h), scale*j:scale*(j + tile_w)] += window
+
+            del tiles
+            del outputs
+
+        return (output_hr / weights)[:, :scale * pic_h, :scale * pic_w]
+
     def save_weights(self,
                      path,
                      epoch,
@@ -712,9 +2176,10 @@ class autoencoder(object):
                      train_ssim,
                      val_ssim):
 
-        if not os.path.exists('./checkpoint/'):
-            os.makedirs('./checkpoint/')
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
 
+        buffer = io.BytesIO()
         torch.save({'epoch': epoch,
                     'model_state_dict': self.model.state_dict(),
                     'optimizer_state_dict': self.optimizer.state_dict(),
@@ -724,31 +2189,169 @@ class autoencoder(object):
                     'val_psnr': val_psnr,
                     'train_ssim': train_ssim,
                     'val_ssim': val_ssim},
-                    path)
+                    buffer)
+        _atomic_write(buffer.getvalue(), path)
+
+    def get_rng_state(self):
+        return {'torch': torch.get_rng_state(),
+                'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+                'numpy': np.random.get_state(),
+                'random': random.getstate()}
+
+    def set_rng_state(self, rng_state):
+        torch.set_rng_state(rng_state['torch'])
+        if rng_state['cuda'] is not None and torch.cuda.is_available():
+            torch.cuda.set_rng_state_all(rng_state['cuda'])
+        np.random.set_state(rng_state['numpy'])
+        random.setstate(rng_state['random'])
 
     def load_weights(self, path):
 
-        checkpoint = torch.load(path, map_location=torch.device(self.device))
+        checkpoint = torch.load(path, map_location=torch.device(self.device), weights_only=False)
 
         self.model.load_state_dict(checkpoint['model_state_dict'])
         self.optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
         self.model.eval()
 
 # Cell
-def fit_and_log(mc, verbose, trials=None):
+class TrialPruner(object):
+    """Stops trials whose best val_ssim falls behind the completed trials at the same evaluation.
+    'median' prunes below the median of the completed trials, 'asha' keeps the top 1/reduction_factor
+    at the rungs grace_evals * reduction_factor**k (successive halving)."""
+    def __init__(self, curves, rule='median', grace_evals=1, reduction_factor=3, min_trials=3):
+        assert rule in ['median', 'asha'], f'Unknown pruning rule {rule}'
+        # Best val_ssim so far of each completed trial at every evaluation
+        self.curves = [np.maximum.accumulate(curve) for curve in curves if len(curve) > 0]
+        self.rule = rule
+        self.grace_evals = max(grace_evals, 1)
+        self.reduction_factor = reduction_factor
+        self.min_trials = min_trials
+
+    def is_rung(self, n_evals):
+        if self.rule == 'median':
+            return n_evals >= self.grace_evals
+        rung = self.grace_evals
+        while rung < n_evals:
+            rung *= self.reduction_factor
+        return rung == n_evals
+
+    def should_prune(self, val_ssim):
+        n_evals = len(val_ssim)
+        if not self.is_rung(n_evals): return False
+
+        peers = [curve[n_evals-1] for curve in self.curves if len(curve) >= n_evals]
+        if len(peers) < self.min_trials: return False
+
+        if self.rule == 'median':
+            cutoff = np.median(peers)
+        else:
+            top_k = max(len(peers) // self.reduction_factor, 1)
+            cutoff = sorted(peers, reverse=True)[top_k-1]
+        return max(val_ssim) < cutoff
+
+def _trial_pruner(mc, trials):
+    # Pruner over the val_ssim trajectories of the finished trials, None if pruning is disabled
+    if mc.get('pruning', None) is None or trials is None: return None
+    curves = [trial['result']['trajectories']['val_ssim'] for trial in trials.trials
+              if trial['result'].get('status') == STATUS_OK and 'trajectories' in trial['result']]
+    return TrialPruner(curves, rule=mc['pruning'],
+                       grace_evals=mc.get('pruning_grace_evals', 1),
+                       reduction_factor=mc.get('pruning_reduction_factor', 3),
+                       min_trials=mc.get('pruning_min_trials', 3))
+
+# Cell
+# Config keys that do not change the result of a trial
+_UNHASHED_KEYS = ['experiment_id', 'path', 'trials_path', 'num_workers', 'result_cache_dir', 'stage_timings',
+                  'profile_steps', 'profile_trace_start', 'profile_trace_steps', 'tile_size', 'tile_overlap',
+                  'tile_batch_size', 'png_compress_level', 'writer_workers', 'writer_max_pending',
+                  'pruning', 'pruning_grace_evals', 'pruning_reduction_factor', 'pruning_min_trials',
+                  'resume', 'checkpoint_top_k', 'inference_model', 'checkpoint_blocks', 'compile']
+
+def _file_digest(file_names, content=True):
+    digest = hashlib.sha1()
+    for f in file_names:
+        digest.update(f.encode())
+        if content:
+            with open(f, 'rb') as file: digest.update(file.read())
+        else:
+            digest.update(str(os.path.getsize(f)).encode())
+    return digest.hexdigest()
+
+def _code_digest():
+    # Source of this module and pytorch_ssim. Cells run in a notebook kernel have no __file__, the
+    # source of the functions (and class methods) they defined is hashed instead
+    digest = hashlib.sha1()
+    if '__file__' in globals():
+        digest.update(_file_digest([__file__]).encode())
+    else:
+        for name, value in sorted(globals().items()):
+            if getattr(value, '__module__', None) != __name__:
+                continue
+            if inspect.isclass(value):
+                functions = [v for _, v in sorted(vars(value).items()) if inspect.isfunction(v)]
+            elif inspect.isfunction(value):
+                functions = [value]
+            else:
+                continue
+            for function in functions:
+                digest.update(inspect.getsource(function).encode())
+    digest.update(_file_digest([pytorch_ssim.__file__]).encode())
+    return digest.hexdigest()
+
+def trial_key(mc):
+    """Stable hash of the resolved config, the data manifest (file names and sizes of the train
+    and val sets) and the code version (source of this module and pytorch_ssim)."""
+
+    config = {k: v for k, v in mc.items() if k not in _UNHASHED_KEYS}
+    config = json.dumps(config, sort_keys=True, default=str)
+
+    data_files = []
+    for mode in ['train', 'val']:
+        for file_names in _list_pictures(mode).values():
+            data_files += file_names
+
+    digest = hashlib.sha1()
+    digest.update(config.encode())
+    digest.update(_file_digest(data_files, content=False).encode())
+    digest.update(_code_digest().encode())
+
+    return digest.hexdigest()
+
+def fit_and_log(mc, verbose, trials=None, pruner=None):
 
     start_time = time.time()
 
+    # Trials already run with the same config, data and code return the stored results
+    cache_dir = mc.get('result_cache_dir', None)
+    if cache_dir is not None:
+        key = trial_key(mc)
+        cache_path = f'{cache_dir}/{key}.p'
+        if os.path.exists(cache_path):
+            print(f'Loading cached results {cache_path}')
+            with open(cache_path, 'rb') as f:
+                results = pickle.load(f)
+            results['cached'] = True
+            return results
+
     train_loader, val_loader, _ = create_dataloaders(mc)
 
     print('='*50)
     print(pd.Series(mc))
     print('='*50+'\n')
 
-    model = autoencoder(params=mc)
+    # Configurations that do not fit the memory budget fail before training
+    try:
+        model = autoencoder(params=mc)
+    except MemoryError as e:
+        print(e)
+        return {'status': STATUS_FAIL, 'mc': mc, 'error': repr(e)}
+
+    if pruner is None:
+        pruner = _trial_pruner(mc, trials)
 
     model.fit(train_loader=train_loader,
-              val_loader=val_loader)
+              val_loader=val_loader,
+              pruner=pruner)
 
     print(f'Model fit time: {time.time() - start_time}')
 
@@ -765,7 +2368,21 @@ def fit_and_log(mc, verbose, trials=None):
                'train_ssim': model.train_ssim,
                'val_ssim': model.val_ssim,
                'run_time': time.time()-start_time,
-               'trajectories': model.trajectories}
+               'trajectories': model.trajectories,
+               'checkpoint_path': getattr(model, 'checkpoint_path', None),
+               'pruned': model.pruned}
+
+    # Pruned results depend on the other trials of the search, they are not cached
+    if cache_dir is not None and not model.pruned and _rank() == 0:
+        os.makedirs(cache_dir, exist_ok=True)
+
+        # Best checkpoint kept with the results, in case the original one is overwritten
+        if results['checkpoint_path'] is not None and os.path.exists(results['checkpoint_path']):
+            with open(results['checkpoint_path'], 'rb') as f:
+                _atomic_write(f.read(), f'{cache_dir}/{key}_ckpt.pth')
+            results['checkpoint_path'] = f'{cache_dir}/{key}_ckpt.pth'
+
+        _atomic_write(pickle.dumps(results), cache_path)
 
     return results
 
@@ -775,8 +2392,120 @@ from hyperopt.pyll.base import scope
 from functools import partial
 import argparse
 import pickle
-import pandas as pd
-from hyperopt import STATUS_OK
+import queue
+import multiprocessing
+from hyperopt import STATUS_OK, STATUS_FAIL, space_eval
+from hyperopt.base import Domain, JOB_STATE_DONE, JOB_STATE_ERROR
+
+# Cell
+def _run_trial(tid, mc, n_threads, results, pruner=None):
+    # Runs in its own process, the cores of the machine are split between trials
+    torch.set_num_threads(n_threads)
+    try:
+        result = fit_and_log(mc, verbose=False, pruner=pruner)
+    except Exception as e:
+        result = {'status': STATUS_FAIL, 'error': repr(e)}
+    results.put((tid, result))
+
+def _save_trials(trials, trials_path):
+    # Atomic write, an interrupted search always finds a complete trials file
+    _atomic_write(pickle.dumps(trials), trials_path)
+
+def parallel_fmin(space, max_evals, n_parallel, trials_path, random_seed=7):
+    """TPE search running n_parallel fit_and_log trials at once in separate processes, each with
+    os.cpu_count() // n_parallel cores split between torch threads and DataLoader workers. The trials
+    are stored in trials_path after every finished trial, and the search resumes from that file."""
+
+    if os.path.exists(trials_path):
+        with open(trials_path, 'rb') as f:
+            trials = pickle.load(f)
+        # Trials interrupted while running are proposed again
+        trials._dynamic_trials = [trial for trial in trials._dynamic_trials
+                                  if trial['state'] in [JOB_STATE_DONE, JOB_STATE_ERROR]]
+        trials.refresh()
+        print(f'Resuming search from {trials_path} ({len(trials.trials)} trials)')
+    else:
+        trials = Trials()
+
+    os.makedirs(os.path.dirname(trials_path) or '.', exist_ok=True)
+
+    domain = Domain(fit_and_log, space)
+
+    # Cores of each trial, half for the torch threads of the training step and the rest for the
+    # DataLoader workers (none with a single core, the batches are then loaded by the trial process)
+    n_cores = max(os.cpu_count() // n_parallel, 1)
+    n_threads = max(n_cores // 2, 1)
+
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    running = {}
+
+    # Trials proposing the config of a running trial (same trial_key) are not trained again,
+    # they wait in duplicates[tid] and get the result of the running trial tid
+    running_keys, duplicates = {}, {}
+
+    while len(trials.trials) - len(running) - sum(map(len, duplicates.values())) < max_evals:
+
+        # New trials proposed with the finished ones
+        while len(running) < n_parallel and len(trials.trials) < max_evals:
+            tid = trials.new_trial_ids(1)[0]
+            new_trials = tpe.suggest([tid], domain, trials, random_seed + tid)
+            trials.insert_trial_docs(new_trials)
+            trials.refresh()
+
+            vals = {k: v[0] for k, v in new_trials[0]['misc']['vals'].items() if len(v) > 0}
+            mc = space_eval(space, vals)
+            mc['num_workers'] = n_cores - n_threads
+
+            key = trial_key(mc)
+            if key in running_keys:
+                duplicates[running_keys[key]].append(tid)
+                continue
+
+            # Trials are compared against the ones finished when they start
+            pruner = _trial_pruner(mc, trials)
+
+            process = context.Process(target=_run_trial, args=(tid, mc, n_threads, results, pruner))
+            process.start()
+            running[tid] = process
+            running_keys[key] = tid
+            duplicates[tid] = []
+
+        try:
+            tid, result = results.get(timeout=60)
+        except queue.Empty:
+            # Processes killed without reporting (e.g. out of memory) are failed trials
+            killed = [tid for tid, process in running.items() if process.exitcode not in [None, 0]]
+            if len(killed) == 0: continue
+            tid, result = killed[0], {'status': STATUS_FAIL, 'error': 'trial process killed'}
+        running.pop(tid).join()
+        running_keys = {key: running_tid for key, running_tid in running_keys.items() if running_tid != tid}
+
+        shared = {duplicate_tid: dict(result, cached=True) for duplicate_tid in duplicates.pop(tid)}
+        shared[tid] = result
+        for trial in trials._dynamic_trials:
+            if trial['tid'] in shared:
+                trial['result'] = shared[trial['tid']]
+                trial['state'] = JOB_STATE_DONE if result['status'] == STATUS_OK else JOB_STATE_ERROR
+        trials.refresh()
+        _save_trials(trials, trials_path)
+
+    return trials
+
+# Cell
+def invalidate_cache(cache_dir, mc=None):
+    """Removes the cached results (and checkpoint) of mc from cache_dir, or every cached
+    result if mc is None."""
+
+    if not os.path.exists(cache_dir): return
+
+    if mc is None:
+        shutil.rmtree(cache_dir)
+        return
+
+    key = trial_key(mc)
+    for path in [f'{cache_dir}/{key}.p', f'{cache_dir}/{key}_ckpt.pth']:
+        if os.path.exists(path): os.remove(path)
 
 # Cell
 def parse_args():
@@ -787,6 +2516,7 @@ def parse_args():
     parser.add_argument('--n_eval_steps', required=True, type=int, help='Number of display and eval steps')
     parser.add_argument('--hyperopt_max_evals', required=True, type=int, help='Hyperopt evaluations')
     parser.add_argument('--experiment_id', required=True, type=str, help='string to identify experiment')
+    parser.add_argument('--n_parallel', default=1, type=int, help='Hyperopt trials running at once')
     return parser.parse_args()
 
 # Cell
@@ -805,10 +2535,22 @@ def main(args, max_evals):
              'h_channels': hp.choice(label='h_channels', options=[[8, 16, 32, 64]]),
              'final_size': hp.choice(label='final_size', options=[2040]),
              'normalize': hp.choice(label='normalize', options=[False]),
+             'native_lr': hp.choice(label='native_lr', options=[False]),
              'data_augmentation': hp.choice(label='data_augmentation', options=[['crop', 'rotate', 'flip']]),
+             'batch_augmentation': hp.choice(label='batch_augmentation', options=[False]),
              'interpolation': hp.choice(label='interpolation', options=[TF.InterpolationMode.BILINEAR]),
              'in_memory': hp.choice(label='in_memory', options=[False]),
+             'stage_timings': hp.choice(label='stage_timings', options=[False]),
+             'packed_dir': hp.choice(label='packed_dir', options=[None]),
+             'patch_size': hp.choice(label='patch_size', options=[None]),
+             'patches_per_image': hp.choice(label='patches_per_image', options=[1]),
              'criterion': hp.choice(label='criterion', options=['mse']),
+             'ssim_band_size': hp.choice(label='ssim_band_size', options=[None]),
+             'precision': hp.choice(label='precision', options=['auto']),
+             'channels_last': hp.choice(label='channels_last', options=[True]),
+             'checkpoint_blocks': hp.choice(label='checkpoint_blocks', options=[None]),
+             'memory_budget': hp.choice(label='memory_budget', options=[None]),
+             'compile': hp.choice(label='compile', options=[True]),
              #------------------------------ Optimization Regularization -----------------------------#
              'batch_size': hp.choice(label='batch_size', options=[args.batch_size]),
 #              'initial_lr': hp.loguniform(label='initial_lr', low=np.log(5e-3), high=np.log(1e-2)),
@@ -819,19 +2561,62 @@ def main(args, max_evals):
              'iterations': hp.choice(label='iterations', options=[iterations]),
              'n_epochs': hp.choice(label='n_epochs', options=[args.n_epochs]),
              'display_step': hp.choice(label='display_step', options=[display_step]),
+             'running_train_metrics': hp.choice(label='running_train_metrics', options=[True]),
+             'eval_subset_size': hp.choice(label='eval_subset_size', options=[None]),
              #--------------------------------------   Others   --------------------------------------#
              'path': hp.choice(label='path', options=[model_path]),
              'trials_path': hp.choice(label='trials_path', options=[trials_path]),
-             'random_seed': hp.choice(label='random_seed', options=[7])}
-
-
-    trials = Trials()
-    fmin_objective = partial(fit_and_log, trials=trials, verbose=True)
-    best_model = fmin(fmin_objective, space=space, algo=tpe.suggest, max_evals=max_evals, trials=trials)
+             'random_seed': hp.choice(label='random_seed', options=[7]),
+             'result_cache_dir': hp.choice(label='result_cache_dir', options=['./results/cache']),
+             'resume': hp.choice(label='resume', options=[True]),
+             'checkpoint_top_k': hp.choice(label='checkpoint_top_k', options=[3]),
+             'pruning': hp.choice(label='pruning', options=['asha']),
+             'pruning_grace_evals': hp.choice(label='pruning_grace_evals', options=[1]),
+             'pruning_reduction_factor': hp.choice(label='pruning_reduction_factor', options=[3]),
+             'pruning_min_trials': hp.choice(label='pruning_min_trials', options=[3]),
+             'profile_steps': hp.choice(label='profile_steps', options=[False]),
+             'profile_trace_start': hp.choice(label='profile_trace_start', options=[None]),
+             'profile_trace_steps': hp.choice(label='profile_trace_steps', options=[5]),
+             'tile_size': hp.choice(label='tile_size', options=[None]),
+             'tile_overlap': hp.choice(label='tile_overlap', options=[32]),
+             'tile_batch_size': hp.choice(label='tile_batch_size', options=[8]),
+             'png_compress_level': hp.choice(label='png_compress_level', options=[6]),
+             'writer_workers': hp.choice(label='writer_workers', options=[4]),
+             'writer_max_pending': hp.choice(label='writer_max_pending', options=[16]),
+             'inference_model': hp.choice(label='inference_model', options=[None])}
+
+
+    # torchrun: every process trains the first configuration of the space together, no search
+    rank, world_size = init_distributed()
+    if world_size > 1:
+        results = fit_and_log(space_eval(space, {label: 0 for label in space}), verbose=True)
+        if rank == 0:
+            print(f"val_psnr: {results['val_psnr']:0.2f} val_ssim: {results['val_ssim']:0.2f}")
+        dist.destroy_process_group()
+        return
+
+    if getattr(args, 'n_parallel', 1) > 1:
+        trials = parallel_fmin(space, max_evals=max_evals, n_parallel=args.n_parallel,
+                               trials_path=trials_path, random_seed=7)
+    else:
+        trials = Trials()
+        fmin_objective = partial(fit_and_log, trials=trials, verbose=True)
+        best_model = fmin(fmin_objective, space=space, algo=tpe.suggest, max_evals=max_evals, trials=trials)
 
     with open(trials_path, "wb") as f:
         pickle.dump(trials, f)
 
+# Cell
+if __name__ == "__main__":
+    gc.collect()
+    gc.get_count()
+    args = parse_args()
+    main(args, max_evals=args.hyperopt_max_evals)
+
+# PYTHONPATH=. python super_resolution/autoencoder.py --n_epochs 100 --batch_size 8  --n_eval_steps 5 --hyperopt_max_evals 3 --experiment_id "debugging"
+# Distributed training of one configuration, e.g. 4 CPU processes (gloo) on one machine:
+# PYTHONPATH=. torchrun --nproc_per_node=4 super_resolution/autoencoder.py --n_epochs 100 --batch_size 8  --n_eval_steps 5 --hyperopt_max_evals 1 --experiment_id "debugging"
+
 # Cell
 def create_test_loaders(folder, mc):
 
@@ -850,4 +2635,207 @@ def create_test_loaders(folder, mc):
                              pin_memory=torch.cuda.is_available(),
                              drop_last=False)
 
-    return test_loader
\ No newline at end of file
+    return test_loader
+
+# Cell
+class InferenceService(object):
+    """Long-running HTTP service around a loaded autoencoder. POST /upscale takes an image and returns the
+    upscaled PNG, GET /metrics returns queue depth, batch sizes and latency percentiles. Requests of the same
+    preprocessed size that arrive within max_delay seconds are stacked into batches of up to max_batch_size."""
+
+    def __init__(self, model, max_batch_size=8, max_delay=0.01, num_workers=4, compress_level=6):
+
+        self.model = model
+        self.model.model.eval()
+        self.params = model.params
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.compress_level = compress_level
+
+        # Decoding and encoding in a thread pool, the model in a single thread
+        self.io_executor = ThreadPoolExecutor(max_workers=num_workers)
+        self.model_executor = ThreadPoolExecutor(max_workers=1)
+        self.queue = None
+
+        self.n_requests = 0
+        self.n_errors = 0
+        self.n_batches = 0
+        self.in_flight = 0
+        self.latencies = deque(maxlen=1000)
+        self.batch_sizes = deque(maxlen=1000)
+
+    def preprocess(self, data):
+        # Same steps as the test PicturesDataset
+        params = self.params
+        pic_lr = TF.pil_to_tensor(Image.open(io.BytesIO(data)).convert('RGB')).float() / 255
+
+        flipped = pic_lr.shape[2] > pic_lr.shape[1]
+        if flipped:
+            pic_lr = pic_lr.transpose(1, 2)
+
+        mean, std = None, None
+        if params['normalize']:
+            mean = torch.mean(pic_lr.flatten(start_dim=1), dim=1)
+            std = torch.std(pic_lr.flatten(start_dim=1), dim=1)
+            pic_lr = TF.normalize(pic_lr, mean=mean, std=std)
+
+        pic_lr_h, pic_lr_w = pic_lr.shape[1], pic_lr.shape[2]
+        if not params.get('native_lr', False):
+            pic_lr = TF.resize(pic_lr, size=[4*pic_lr_h, 4*pic_lr_w], interpolation=params['interpolation'])
+
+        if not params.get('tile_size', None):
+            size = params['final_size'] // self.model.upscale_factor
+            pic_lr = TF.resize(pic_lr, size=[size, size], interpolation=params['interpolation'])
+
+        return pic_lr, {'size': [4*pic_lr_h, 4*pic_lr_w], 'flipped': flipped, 'mean': mean, 'std': std}
+
+    def predict(self, pics_lr):
+        params = self.params
+        with torch.no_grad():
+            if params.get('tile_size', None):
+                return [self.model.predict_tiled(pic_lr,
+                                                 tile_size=params['tile_size'],
+                                                 tile_overlap=params.get('tile_overlap', 0),
+                                                 tile_batch_size=params.get('tile_batch_size', 8))
+                        for pic_lr in pics_lr]
+            x_lr = torch.stack(pics_lr).to(self.model.device)
+            return list(self.model.infer(x_lr.float()).float().cpu())
+
+    def postprocess(self, output_hr, meta):
+
+        if not self.params.get('tile_size', None):
+            output_hr = TF.resize(output_hr, size=meta['size'], interpolation=TF.InterpolationMode.BICUBIC)
+
+        if meta['mean'] is not None:
+            output_hr = output_hr * meta['std'].view(-1, 1, 1) + meta['mean'].view(-1, 1, 1)
+
+        if meta['flipped']:
+            output_hr = output_hr.transpose(1, 2)
+
+        pic = output_hr.mul(255).add_(0.5).clamp_(0, 255).permute(1, 2, 0).to(torch.uint8).numpy()
+        buffer = io.BytesIO()
+        Image.fromarray(pic).save(buffer, format='PNG', compress_level=self.compress_level)
+        return buffer.getvalue()
+
+    async def batcher(self):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            requests = [await self.queue.get()]
+
+            # Waits at most max_delay after the first request for the batch to fill up
+            deadline = loop.time() + self.max_delay
+            while len(requests) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0: break
+                try:
+                    requests.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            groups = {}
+            for pic_lr, future in requests:
+                groups.setdefault(tuple(pic_lr.shape), []).append((pic_lr, future))
+
+            for group in groups.values():
+                try:
+                    outputs = await loop.run_in_executor(self.model_executor, self.predict,
+                                                         [pic_lr for pic_lr, _ in group])
+                    for (_, future), output_hr in zip(group, outputs):
+                        if not future.done(): future.set_result(output_hr)
+                except Exception as e:
+                    for _, future in group:
+                        if not future.done(): future.set_exception(e)
+
+                self.n_batches += 1
+                self.batch_sizes.append(len(group))
+
+    async def upscale(self, data):
+        loop = asyncio.get_running_loop()
+
+        pic_lr, meta = await loop.run_in_executor(self.io_executor, self.preprocess, data)
+        future = loop.create_future()
+        await self.queue.put((pic_lr, future))
+        output_hr = await future
+
+        return await loop.run_in_executor(self.io_executor, self.postprocess, output_hr, meta)
+
+    def metrics(self):
+        latencies = np.array(self.latencies) if len(self.latencies) > 0 else np.zeros(1)
+        return {'queue_depth': self.queue.qsize(),
+                'in_flight': self.in_flight,
+                'requests': self.n_requests,
+                'errors': self.n_errors,
+                'batches': self.n_batches,
+                'mean_batch_size': float(np.mean(self.batch_sizes)) if len(self.batch_sizes) > 0 else 0.,
+                'latency_p50': float(np.percentile(latencies, 50)),
+                'latency_p95': float(np.percentile(latencies, 95)),
+                'latency_p99': float(np.percentile(latencies, 99))}
+
+    async def handle(self, reader, writer):
+        # Minimal HTTP/1.1, one request per connection
+        start = time.perf_counter()
+        self.in_flight += 1
+        try:
+            method, target, _ = (await reader.readline()).decode().split(' ', 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in [b'\r\n', b'\n', b'']: break
+                key, value = line.decode().split(':', 1)
+                headers[key.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+            if method == 'POST' and target == '/upscale':
+                self.n_requests += 1
+                status, content_type, content = '200 OK', 'image/png', await self.upscale(body)
+                self.latencies.append(time.perf_counter() - start)
+            elif method == 'GET' and target == '/metrics':
+                status, content_type, content = '200 OK', 'application/json', json.dumps(self.metrics()).encode()
+            else:
+                status, content_type, content = '404 Not Found', 'text/plain', b'Not found'
+
+        except Exception as e:
+            self.n_errors += 1
+            status, content_type, content = '500 Internal Server Error', 'text/plain', repr(e).encode()
+
+        finally:
+            self.in_flight -= 1
+
+        writer.write(f'HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n'
+                     f'Content-Length: {len(content)}\r\nConnection: close\r\n\r\n'.encode() + content)
+        await writer.drain()
+        writer.close()
+
+    async def serve(self, host='127.0.0.1', port=8080, unix_socket=None):
+
+        self.queue = asyncio.Queue()
+        batcher = asyncio.ensure_future(self.batcher())
+
+        if unix_socket is not None:
+            server = await asyncio.start_unix_server(self.handle, path=unix_socket)
+        else:
+            server = await asyncio.start_server(self.handle, host, port)
+        print(f'Serving on {unix_socket or f"{host}:{port}"}')
+
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+
+def serve(mc, path, host='127.0.0.1', port=8080, unix_socket=None, max_batch_size=8, max_delay=0.01):
+    """Loads the checkpoint (or exported .pt model) at path once and serves it with InferenceService."""
+
+    model = autoencoder(params=mc)
+    if path.endswith('.pt'):
+        model.load_exported(path)
+    else:
+        model.load_weights(path)
+
+    service = InferenceService(model,
+                               max_batch_size=max_batch_size,
+                               max_delay=max_delay,
+                               num_workers=mc.get('writer_workers', 4),
+                               compress_level=mc.get('png_compress_level', 6))
+    asyncio.run(service.serve(host=host, port=port, unix_socket=unix_socket))